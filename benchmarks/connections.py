@@ -0,0 +1,35 @@
+from quarry.net.server import ServerFactory
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+
+from waitingserver.protocol import Protocol
+
+# Connections for benchmarks, built by the factory and connected to an in-memory transport as the server would
+
+
+def create_factory() -> ServerFactory:
+    factory = ServerFactory()
+    factory.protocol = Protocol
+    factory.max_players = 65535
+    factory.motd = "Benchmark"
+    factory.online_mode = False
+    factory.compression_threshold = 1500
+    factory.server_statuses = dict()
+    factory.bungee_forwarding = False
+    factory.velocity_forwarding = False
+
+    return factory
+
+
+# A connection in the given protocol mode, as if the handshake had selected the given protocol version
+def create_protocol(factory: ServerFactory, port: int, transport: StringTransport = None,
+                    protocol_version: int = None, protocol_mode: str = "play") -> Protocol:
+    protocol = factory.buildProtocol(IPv4Address('TCP', '127.0.0.1', port))
+    protocol.makeConnection(transport if transport is not None else StringTransport())
+
+    if protocol_version is not None:
+        protocol.protocol_version = protocol_version
+
+    protocol.protocol_mode = protocol_mode
+
+    return protocol
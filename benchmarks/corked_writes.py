@@ -0,0 +1,70 @@
+import time
+
+from twisted.internet.testing import StringTransport
+
+from benchmarks.connections import create_factory, create_protocol
+from waitingserver.protocol import Protocol
+from waitingserver.versions import Version_1_21
+
+# Cost of writing a join's worth of packets to a transport, one write per packet vs corked into batches
+# Uses Protocol.send_framed with an in-memory transport, so measures the per-write overhead rather than syscalls
+# Usage: python -m benchmarks.corked_writes (from the repository root)
+
+JOINS = 200
+CHUNKS = [('level_chunk_with_light', bytes(8000))] * 400
+ENTITIES = [('add_entity', bytes(40)), ('set_entity_data', bytes(60))] * 100
+OTHER = [('sound', bytes(30)), ('set_time', bytes(20)), ('game_event', bytes(8))] * 10
+
+
+class CountingTransport(StringTransport):
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def write(self, data):
+        self.calls += 1
+        super().write(data)
+
+    def writeSequence(self, data):
+        self.calls += 1
+        super().writeSequence(data)
+
+
+def send_join(protocol: Protocol, corked: bool):
+    batches = [CHUNKS[i:i + 16] for i in range(0, len(CHUNKS), 16)] + [ENTITIES + OTHER]
+
+    for batch in batches:
+        if corked:
+            protocol.cork()
+
+        for name, data in batch:
+            protocol.send_framed(name, data)
+
+        if corked:
+            protocol.uncork()
+
+
+def main():
+    factory = create_factory()
+
+    for name, corked in (('uncorked', False), ('corked', True)):
+        calls = 0
+        duration = 0
+
+        for i in range(0, JOINS):
+            transport = CountingTransport()
+            protocol = create_protocol(factory, i, transport, Version_1_21.protocol_version)
+            transport.calls = 0  # Ignore anything written while connecting
+
+            start = time.perf_counter()
+            send_join(protocol, corked)
+            duration += time.perf_counter() - start
+            calls += transport.calls
+
+        print('{:<9} {:6.3f} ms per join, {:5.0f} transport calls per join'.format(
+            name, duration / JOINS * 1000, calls / JOINS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import math
+import random
+import timeit
+
+import yaml
+from yaml import SafeLoader
+
+from waitingserver.world import World
+
+# Per movement packet cost of the portal and bounds checks
+# Usage: python -m benchmarks.portal_lookup (from the repository root)
+
+ITERATIONS = 200000
+
+
+# Previous implementation, flooring and normalising the portal corners on every call
+def linear_portal_at(world: World, x, y, z):
+    x = math.floor(x)
+    y = math.floor(y)
+    z = math.floor(z)
+
+    for portal in world.portals:
+        pos1x = min(portal.pos1[0], portal.pos2[0])
+        pos1y = min(portal.pos1[1], portal.pos2[1])
+        pos1z = min(portal.pos1[2], portal.pos2[2])
+
+        pos2x = max(portal.pos1[0], portal.pos2[0])
+        pos2y = max(portal.pos1[1], portal.pos2[1])
+        pos2z = max(portal.pos1[2], portal.pos2[2])
+
+        if pos1x <= x <= pos2x and pos1y <= y <= pos2y and pos1z <= z <= pos2z:
+            return portal.destination
+
+    return None
+
+
+def main():
+    with open(r'./config.yml') as file:
+        config = yaml.load(file, Loader=SafeLoader)
+
+    world_config = next(w for w in config.get('worlds') if len(w.get('portals', list())))
+    world = World(world_config.get('name'), world_config.get('folder'), 'benchmark', world_config, True)
+
+    random.seed(0)
+    positions = [(random.uniform(-16, 16), random.uniform(28, 34), random.uniform(-16, 16)) for i in range(0, 1024)]
+
+    for x, y, z in positions:
+        assert world.get_portal_at(x, y, z) == linear_portal_at(world, x, y, z)
+
+    def run(check):
+        def loop():
+            for i in range(0, ITERATIONS):
+                x, y, z = positions[i & 1023]
+                check(x, y, z)
+
+        return min(timeit.repeat(loop, number=1, repeat=5)) / ITERATIONS * 1e9
+
+    print('World: {} ({} portals)'.format(world.name, len(world.portals)))
+    print('get_portal_at (linear):  {:.0f} ns/packet'.format(run(lambda x, y, z: linear_portal_at(world, x, y, z))))
+    print('get_portal_at (indexed): {:.0f} ns/packet'.format(run(world.get_portal_at)))
+    print('is_within_bounds:        {:.0f} ns/packet'.format(run(world.is_within_bounds)))
+
+
+if __name__ == '__main__':
+    main()
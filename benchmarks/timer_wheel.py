@@ -0,0 +1,63 @@
+import time
+
+from benchmarks.connections import create_factory, create_protocol
+from waitingserver.timers import TimerWheel, keep_alive_timer, music_timer
+from waitingserver.versions import Version_1_21
+
+# Per-tick cost of keep alive and music timers at 10k idle connections
+# Compares connections that joined in a burst and fire in lockstep (as with per-connection ticker loops)
+# against the same connections spread over the server's timer wheels
+# Each timer sends through Version.send_cached, as registered by Version.player_joined
+# Usage: python -m benchmarks.timer_wheel (from the repository root)
+
+CONNECTIONS = 10000
+TICKS = 400
+
+
+# Places every connection in the first slot, so they all fire on the same tick
+class LockstepWheel(TimerWheel):
+
+    def next_slot(self) -> int:
+        return 0
+
+
+def add_timers(keep_alive: TimerWheel, music: TimerWheel, version: Version_1_21):
+    keep_alive.add(version, lambda: version.send_cached(('keep_alive',), version.send_keep_alive))
+    music.add(version, lambda: version.send_cached_music(True))
+
+
+def run(wheels, ticks):
+    durations = []
+
+    for i in range(0, ticks):
+        start = time.perf_counter()
+
+        for wheel in wheels:
+            wheel.advance()
+
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+
+def main():
+    factory = create_factory()
+    versions = [Version_1_21(create_protocol(factory, i, protocol_version=Version_1_21.protocol_version))
+                for i in range(0, CONNECTIONS)]
+
+    lockstep_keep_alive = LockstepWheel(keep_alive_timer.interval)
+    lockstep_music = LockstepWheel(music_timer.interval)
+
+    for version in versions:
+        add_timers(lockstep_keep_alive, lockstep_music, version)
+        add_timers(keep_alive_timer, music_timer, version)
+
+    for name, wheels in (('lockstep', (lockstep_keep_alive, lockstep_music)), ('wheel', (keep_alive_timer, music_timer))):
+        durations = run(wheels, TICKS)
+
+        print('{:<9} max tick {:7.2f} ms, mean tick {:6.3f} ms'.format(
+            name, max(durations) * 1000, sum(durations) / len(durations) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,7 @@ import os
 from quarry.types.nbt import TagRoot, NBTFile
 from typing import List
 
+from waitingserver.cache import asset_cache, file_key
 from waitingserver.direction import Direction
 
 
@@ -26,10 +27,14 @@ class Map:
 												   str(y) if self.height > 1 else '')
 				path = os.path.join(os.getcwd(), './maps', name, version, filename)
 
-				self.maps.append(MapPart(map_id, NBTFile(TagRoot({})).load(path)))
+				colors = asset_cache.get('map', path, file_key(path), lambda: read_map_colors(path))
+
+				self.maps.append(MapPart(map_id, colors))
 
 				map_id += 1
 
+		self.maps = tuple(self.maps)
+
 	@staticmethod
 	def get_spawn_pos(pos: List[float], direction: Direction, xoffset: int = 0, yoffset: int = 0):
 		if direction == Direction.NORTH:
@@ -46,10 +51,30 @@ class Map:
 			return [pos[0] + (0.5 + xoffset), pos[1] + 1.03125, pos[2] + (0.5 + yoffset)]
 
 
+# Colours of a map .dat file, as sent in map_item_data packets
+def read_map_colors(path: str) -> bytes:
+	data = NBTFile(TagRoot({})).load(path)
+	return bytes(color & 0xFF for color in data.root_tag.body.to_obj().get('data', dict()).get('colors', list()))
+
+
 class MapPart:
+	__slots__ = ('map_id', 'colors', 'bodies', 'framed')
 
-	def __init__(self, map_id: int, data: NBTFile):
+	def __init__(self, map_id: int, colors: bytes):
 		self.map_id = map_id
-		self.data = data.root_tag.body.to_obj().get('data', dict()).get('colors', list())
+		self.colors = colors
+
+		self.bodies = dict()  # map_item_data encoder -> packet body, built by Version.prepare_maps()
+		self.framed = dict()  # (protocol version, compression threshold) -> framed packet
+
+	# Framed and compressed map_item_data packet, built on first use and shared by every connection using the same key
+	def get_framed(self, protocol, body: bytes) -> bytes:
+		key = (protocol.protocol_version, protocol.compression_threshold)
+		framed = self.framed.get(key)
+
+		if framed is None:
+			framed = protocol.frame_packet("map_item_data", body)
+			self.framed[key] = framed
 
+		return framed
 
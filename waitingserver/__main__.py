@@ -1,14 +1,23 @@
+import gc
 import os
+import socket
 import sys
-from argparse import ArgumentParser
+import time
+from argparse import ArgumentParser, SUPPRESS
 
 from quarry.net.server import ServerFactory
 from twisted.internet import reactor
+from twisted.internet.stdio import StandardIO
+from twisted.internet.task import LoopingCall
 
-from waitingserver.config import load_config
+from waitingserver.config import load_config, unload_idle_worlds
 from waitingserver.log import logger
-from waitingserver.prometheus import init_prometheus
+from waitingserver.ping import status_cache, ping_limiter
+from waitingserver.prometheus import init_prometheus, init_gc_metrics, set_startup_time
 from waitingserver.protocol import Protocol, build_versions
+from waitingserver.status import StatusListener, StatusRelayReceiver, handle_status_update
+from waitingserver.streaming import scheduler
+from waitingserver.workers import Supervisor, attach_player_counts, listen_reuseport
 
 if getattr(sys, 'frozen', False):  # PyInstaller adds this attribute
     # Running in a bundle
@@ -27,9 +36,38 @@ parser.add_argument("-s", "--voting", type=str,
 parser.add_argument("-b", "--bungeecord", action='store_true', help="Enables bungeecord forwarding support")
 parser.add_argument("-v", "--velocity", default=None, type=str, help="enable velocity modern forwarding support with the given secret")
 parser.add_argument("-d", "--debug", action='store_true', help="Shows debug markers for maps spawns and portals in the current world")
+parser.add_argument("-j", "--max-joins", default=None, type=int,
+                    help="maximum number of worlds to send at once, further joins are queued")
+parser.add_argument("--ping-rate", default=None, type=float,
+                    help="maximum status pings per second from a single address")
+parser.add_argument("--player-bucket", default=1, type=int,
+                    help="player count granularity of cached status responses")
+parser.add_argument("-t", "--status-port", default=None, type=int,
+                    help="accept signed status updates over UDP on the specified port")
+parser.add_argument("-w", "--workers", default=1, type=int, help="number of worker processes sharing the bind port")
+parser.add_argument("--worker", default=None, type=int, help=SUPPRESS)
+parser.add_argument("--player-counts", default=None, type=str, help=SUPPRESS)
 
 args = parser.parse_args()
 
+# Supervisor for multi-process mode, spawns workers which each load the config and listen with SO_REUSEPORT
+if args.workers > 1 and args.worker is None:
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        logger.error("Multiple workers are not supported on this platform.")
+        exit(1)
+
+    supervisor = Supervisor(args.workers, sys.argv[1:])
+    supervisor.start()
+
+    if args.metrics is not None:
+        init_prometheus(args.host, args.metrics, supervisor.metrics_dir)
+
+    if args.status_port is not None:
+        reactor.listenUDP(args.status_port, StatusListener(supervisor.send_status), interface=args.host)
+
+    reactor.run()
+    exit(0)
+
 if args.bungeecord is True and args.velocity is True:
     logger.error("Cannot use both bungeecord and velocity forwarding at the same time.")
     exit(1)
@@ -51,10 +89,21 @@ server_factory.bungee_forwarding = args.bungeecord
 server_factory.velocity_forwarding = args.velocity is not None
 server_factory.velocity_forwarding_secret = args.velocity
 
+load_start = time.perf_counter()
 load_config()
 build_versions()
 
-if args.metrics is not None:
+load_time = time.perf_counter() - load_start
+set_startup_time(load_time)
+logger.info('Loaded config in {:.2f}s'.format(load_time))
+
+# Worlds, maps and packet indexes live until shutdown, so stop the collector rescanning them
+gc.collect()
+gc.freeze()
+init_gc_metrics()
+
+# Workers expose metrics through the supervisor
+if args.metrics is not None and args.worker is None:
     init_prometheus(args.host, args.metrics)
 
 import waitingserver.config
@@ -62,8 +111,27 @@ Protocol.debug_mode = args.debug
 Protocol.voting_mode = args.voting is not None
 Protocol.voting_secret = args.voting
 Protocol.status_secret = waitingserver.config.status_secret
+scheduler.limit = args.max_joins
+status_cache.bucket_size = max(1, args.player_bucket)
+ping_limiter.rate = args.ping_rate
+
+if waitingserver.config.lazy_load and waitingserver.config.unload_after is not None:
+    # Players still logging in, or on an unsupported version, have no version
+    LoopingCall(lambda: unload_idle_worlds({player.version.current_world for player in server_factory.players
+                                            if player.version is not None})).start(60, now=False)
+
+if args.worker is not None:
+    attach_player_counts(args.player_counts, args.worker, args.workers)
+    StandardIO(StatusRelayReceiver(server_factory, Protocol.status_secret))
+    listen_reuseport(server_factory, args.host, args.port)
+    logger.info('Worker {} started'.format(args.worker))
+else:
+    server_factory.listen(args.host, args.port)
+    logger.info('Server started')
+
+    if args.status_port is not None:
+        reactor.listenUDP(args.status_port, StatusListener(
+            lambda data: handle_status_update(server_factory, data, Protocol.status_secret)), interface=args.host)
 
-server_factory.listen(args.host, args.port)
-logger.info('Server started')
 logger.info("Listening on {}:{}".format(args.host, args.port))
 reactor.run()
@@ -0,0 +1,134 @@
+import glob
+import mmap
+import os
+import re
+import struct
+import sys
+from collections import namedtuple
+from typing import List, Optional, Tuple
+
+# Packed world archive format, one file per world/version, stored as packets/<folder>/<version>.pack
+#
+# Header:  magic (4s), format version (H), entry count (I)
+# Entry:   packet id (I), flags (B), chunk x (i), chunk z (i), offset (Q), length (I),
+#          name length (H), name, type length (B), type
+# Data:    packet payloads, in entry order. Entries with identical payloads share a single copy.
+#
+# Entries are stored in file name order, so the ordering of the original .bin files (including _dn packets) is kept.
+
+ARCHIVE_EXTENSION = '.pack'
+ARCHIVE_MAGIC = b'WSPK'
+ARCHIVE_VERSION = 1
+
+FLAG_DN = 1
+FLAG_CHUNK = 2
+
+header_struct = struct.Struct('>4sHI')
+entry_struct = struct.Struct('>IBiiQIH')
+
+filename_pattern = re.compile(r'(\d+)(_dn)?_([a-z_]+)(_[\w-]*)?.bin')
+chunk_pattern = re.compile(r'_(-?\d+)_(-?\d+)')
+
+ArchiveEntry = namedtuple('ArchiveEntry', ['id', 'type', 'name', 'dn', 'chunk', 'offset', 'length'])
+
+
+# Parse a packet file name into its id, type, _dn flag and chunk coordinates (if present)
+def parse_packet_filename(filename: str) -> Tuple[int, str, bool, Optional[Tuple[int, int]]]:
+    match = filename_pattern.match(os.path.basename(filename))
+    chunk = None
+
+    if match.group(4) is not None:
+        coords = chunk_pattern.fullmatch(match.group(4))
+
+        if coords is not None:
+            chunk = (int(coords.group(1)), int(coords.group(2)))
+
+    return int(match.group(1)), match.group(3), match.group(2) is not None, chunk
+
+
+class WorldArchive:
+
+    # Entries may be passed in if already known, to skip reading the index
+    def __init__(self, path: str, entries: Optional[List[ArchiveEntry]] = None):
+        self.path = path
+        self.entries: List[ArchiveEntry] = entries if entries is not None else read_archive_index(path)
+
+        with open(path, 'rb') as file:
+            # Packet data is left to the page cache and only read when a packet is sent
+            self.data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def read(self, entry: ArchiveEntry) -> memoryview:
+        return self.data[entry.offset:entry.offset + entry.length]
+
+
+def read_archive_index(path: str) -> List[ArchiveEntry]:
+    entries = []
+
+    with open(path, 'rb') as file:
+        magic, version, count = header_struct.unpack(file.read(header_struct.size))
+
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            raise ValueError('{} is not a supported world archive'.format(path))
+
+        for i in range(0, count):
+            id, flags, x, z, offset, length, name_length = entry_struct.unpack(file.read(entry_struct.size))
+            name = file.read(name_length).decode('utf-8')
+            type = file.read(file.read(1)[0]).decode('utf-8')
+
+            entries.append(ArchiveEntry(id, type, name, bool(flags & FLAG_DN),
+                                        (x, z) if flags & FLAG_CHUNK else None, offset, length))
+
+    return entries
+
+
+# Pack the .bin files in a world/version folder into a single archive
+def write_archive(folder: str, path: str):
+    packets = []
+
+    for filename in sorted(glob.glob(os.path.join(folder, '*.bin'))):
+        with open(filename, 'rb') as file:
+            id, type, dn, chunk = parse_packet_filename(filename)
+            packets.append((id, type.encode('utf-8'), os.path.basename(filename).encode('utf-8'), dn, chunk,
+                            file.read()))
+
+    offset = header_struct.size + sum(entry_struct.size + len(name) + 1 + len(type)
+                                      for id, type, name, dn, chunk, payload in packets)
+    headers = []
+    offsets = dict()  # Payload -> offset, so identical payloads are only stored once
+    payloads = []
+
+    for id, type, name, dn, chunk, payload in packets:
+        flags = (FLAG_DN if dn else 0) | (FLAG_CHUNK if chunk is not None else 0)
+        x, z = chunk if chunk is not None else (0, 0)
+
+        if payload not in offsets:
+            offsets[payload] = offset
+            payloads.append(payload)
+            offset += len(payload)
+
+        headers.append(entry_struct.pack(id, flags, x, z, offsets[payload], len(payload), len(name)) + name
+                       + bytes([len(type)]) + type)
+
+    with open(path + '.tmp', 'wb') as file:
+        file.write(header_struct.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(packets)))
+        file.writelines(headers)
+        file.writelines(payloads)
+
+    os.replace(path + '.tmp', path)
+
+
+# Pack every world/version folder under the given packets folder
+# Usage: python -m waitingserver.archive [packets folder]
+def main(argv: List[str]):
+    packets_folder = argv[1] if len(argv) > 1 else os.path.join(os.getcwd(), 'packets')
+
+    for folder in sorted(glob.glob(os.path.join(packets_folder, '*', '*/'))):
+        folder = os.path.normpath(folder)
+        path = folder + ARCHIVE_EXTENSION
+
+        write_archive(folder, path)
+        print('Packed {} ({} bytes)'.format(path, os.path.getsize(path)))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
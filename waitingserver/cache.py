@@ -0,0 +1,106 @@
+import os
+import pickle
+import sys
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from waitingserver.log import logger
+
+# Compiled asset cache, holding packet indexes and map colours between restarts
+# Each entry is stored with a key describing its source files, and is rebuilt whenever that key changes.
+# Packet data itself isn't cached, pack archives already keep it in a single mapped file.
+# The cache is stored in the packets folder, alongside the world data it describes.
+
+CACHE_FILENAME = '.waitingserver.cache'
+CACHE_VERSION = 1
+
+
+# Key for a single file, changed by any write to it
+def file_key(path: str) -> Tuple[int, int]:
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+# Key for a folder's listing, changed when files are added, removed or renamed
+# None for a folder which doesn't exist, which has no files to index
+def folder_key(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class AssetCache:
+
+    def __init__(self):
+        self.path: Optional[str] = None  # Not saved until loaded from a folder
+        self.entries: Dict[Tuple[str, str], Tuple[Hashable, Any]] = dict()  # (kind, source path) -> (key, value)
+        self.used: Dict[Tuple[str, str], Tuple[Hashable, Any]] = dict()
+        self.hits = 0
+        self.misses = 0
+
+    # Load the cache stored in the given folder
+    # Caches which can't be read, or were written by another cache or python version, are deleted and rebuilt
+    def load(self, folder: str):
+        self.path = os.path.join(folder, CACHE_FILENAME)
+        self.entries = dict()
+        self.used = dict()
+        self.hits = 0
+        self.misses = 0
+
+        try:
+            with open(self.path, 'rb') as file:
+                version, python, entries = pickle.load(file)
+
+            if version != CACHE_VERSION or python != sys.version_info[:2] or not isinstance(entries, dict):
+                raise ValueError('Asset cache is from another version')
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning('Discarding asset cache {}: {}'.format(self.path, e))
+            self.discard()
+            return
+
+        self.entries = entries
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    # Value for the given source, from the cache if its key is unchanged, otherwise from build()
+    def get(self, kind: str, path: str, key: Hashable, build: Callable[[], Any]) -> Any:
+        cached = self.entries.get((kind, path))
+
+        if cached is not None and cached[0] == key:
+            self.hits += 1
+            value = cached[1]
+        else:
+            self.misses += 1
+            value = build()
+
+        self.used[(kind, path)] = (key, value)
+
+        return value
+
+    # Write the entries used by this load, if any were rebuilt or are no longer used
+    # Written to a temporary file first, as workers may be saving at the same time
+    def save(self):
+        if self.path is None or (self.misses == 0 and len(self.used) == len(self.entries)):
+            return
+
+        temp_path = '{}.{}'.format(self.path, os.getpid())
+
+        try:
+            with open(temp_path, 'wb') as file:
+                pickle.dump((CACHE_VERSION, sys.version_info[:2], self.used), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+            os.replace(temp_path, self.path)
+        except OSError:
+            logger.warning('Failed to write asset cache {}'.format(self.path), exc_info=True)
+
+        self.entries = self.used
+        self.used = dict()
+
+
+asset_cache = AssetCache()
@@ -1,18 +1,20 @@
 import logging
 import os
+import time
 
 import glob
 
 from yaml import SafeLoader
 
 from waitingserver.Map import Map
+from waitingserver.archive import ARCHIVE_EXTENSION
+from waitingserver.cache import asset_cache
 from waitingserver.world import World
-from waitingserver.log import file_handler, console_handler
+from waitingserver.log import queue_handler, sampling_filter
 import yaml
 
 logger = logging.getLogger('config')
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+logger.addHandler(queue_handler)
 logger.setLevel(logging.DEBUG)
 
 worlds = {}
@@ -20,6 +22,8 @@ default_world = {}
 maps = {}
 status_secret = None
 voting_url = None
+lazy_load = False
+unload_after = None
 
 
 def load_config():
@@ -27,12 +31,19 @@ def load_config():
     global worlds
     global status_secret
     global voting_url
+    global lazy_load
+    global unload_after
+
+    asset_cache.load(os.path.join(os.getcwd(), './packets'))
 
     with open(r'./config.yml') as file:
         config = yaml.load(file, Loader=SafeLoader)
         default = config.get('default-world', None)
         status_secret = config.get('status-secret', None)
         voting_url = config.get('voting-url', None)
+        lazy_load = config.get('lazy-load', False) is True
+        unload_after = config.get('unload-after', None)
+        sampling_filter.rate = float(config.get('portal-log-sample-rate', 1.0))
 
         if not len(status_secret):
             status_secret = None
@@ -55,18 +66,23 @@ def load_config():
                 logger.error('Folder for world %s does not exist. Skipped.', name)
                 continue
 
-            for subFolder in glob.glob(os.path.join(folder_path, '*/')):
-                version = os.path.basename(os.path.normpath(subFolder))
+            # Versions are either subfolders of .bin files or packed archives
+            versions = {os.path.basename(os.path.normpath(subFolder))
+                        for subFolder in glob.glob(os.path.join(folder_path, '*/'))}
+            versions.update(os.path.basename(archive)[:-len(ARCHIVE_EXTENSION)]
+                            for archive in glob.glob(os.path.join(folder_path, '*' + ARCHIVE_EXTENSION)))
 
+            for version in sorted(versions):
                 if worlds.get(version) is None:
                     worlds[version] = []
 
-                world = World(name, folder, version, w)
-                logger.info('Loaded {} for version {}'.format(world.name, version))
+                world = World(name, folder, version, w, lazy_load)
+                logger.info('{} {} for version {}'.format('Indexed' if lazy_load else 'Loaded', world.name, version))
 
                 if default == world.name:
                     default_world[version] = world
 
+                world.index = len(worlds[version])
                 worlds[version].append(world)
 
         for version in worlds:
@@ -106,6 +122,23 @@ def load_config():
                 maps[version][name] = map
                 map_id += (width * height)
 
+    logger.info('Asset cache: {} entries reused, {} rebuilt'.format(asset_cache.hits, asset_cache.misses))
+    asset_cache.save()
+
 
 def get_default_world(version):
     return default_world.get(version, None)
+
+
+# Unload worlds which no player is in and which haven't been sent for unload_after seconds
+def unload_idle_worlds(in_use):
+    if unload_after is None:
+        return
+
+    now = time.time()
+
+    for version in worlds:
+        for world in worlds[version]:
+            if world.loaded and world not in in_use and now - world.last_used > unload_after:
+                world.unload()
+                logger.info('Unloaded idle world {} for version {}'.format(world.name, version))
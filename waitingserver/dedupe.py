@@ -0,0 +1,70 @@
+import glob
+import hashlib
+import os
+import sys
+from collections import defaultdict
+from typing import Dict, List
+
+# Report duplicate packet files across every world and version, and optionally collapse them into hard links
+# Packed archives store identical payloads within an archive once, and the loader shares identical payloads in memory
+# Usage: python -m waitingserver.dedupe [packets folder] [--link]
+
+
+def find_duplicates(packets_folder: str) -> Dict[bytes, List[str]]:
+    files = defaultdict(list)
+
+    for filename in sorted(glob.glob(os.path.join(packets_folder, '*', '*', '*.bin'))):
+        with open(filename, 'rb') as file:
+            files[hashlib.sha256(file.read()).digest()].append(filename)
+
+    return {digest: filenames for digest, filenames in files.items() if len(filenames) > 1}
+
+
+# Replace each duplicate with a hard link to the first copy, skipping files which are already linked to it
+def link_duplicates(filenames: List[str]) -> int:
+    original = filenames[0]
+    linked = 0
+
+    for filename in filenames[1:]:
+        if os.path.samefile(original, filename):
+            continue
+
+        os.link(original, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+        linked += 1
+
+    return linked
+
+
+def main(argv: List[str]):
+    link = '--link' in argv
+    args = [arg for arg in argv[1:] if arg != '--link']
+    packets_folder = args[0] if len(args) else os.path.join(os.getcwd(), 'packets')
+
+    duplicates = find_duplicates(packets_folder)
+    by_world = defaultdict(int)
+    total = 0
+    linked = 0
+
+    for filenames in duplicates.values():
+        size = os.path.getsize(filenames[0])
+
+        for filename in filenames[1:]:
+            world = os.path.relpath(filename, packets_folder).split(os.sep)[0]
+            by_world[world] += size
+            total += size
+
+        if link:
+            linked += link_duplicates(filenames)
+
+    for world, size in sorted(by_world.items()):
+        print('{:<20} {:>12} duplicate bytes'.format(world, size))
+
+    print('{} duplicated payloads, {} duplicate bytes in total'.format(len(duplicates), total))
+
+    if link:
+        print('Linked {} files'.format(linked))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,5 +1,9 @@
+import atexit
 import logging
+import queue
+import random
 import sys
+from logging.handlers import QueueHandler, QueueListener
 
 logger = logging.getLogger('waitingserver')
 logger.setLevel(logging.DEBUG)
@@ -9,5 +13,43 @@ console_handler = logging.StreamHandler(sys.stderr)
 formatter = logging.Formatter('[%(asctime)s %(levelname)s]: [%(name)s] %(message)s')
 console_handler.setFormatter(formatter)
 file_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+
+
+# Drops a proportion of records logged with extra={'sampled': True}, for high volume lines such as portal transfers
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return self.rate >= 1 or not getattr(record, 'sampled', False) or random.random() < self.rate
+
+
+# Records are queued and written by the listener's thread, so the reactor never blocks on the log file or stderr
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+sampling_filter = SamplingFilter()
+queue_handler.addFilter(sampling_filter)
+
+listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+logger.addHandler(queue_handler)
+
+# Shared by all connections, matching quarry's default log level so per packet debug lines are skipped
+protocol_logger = logging.getLogger('waitingserver.protocol')
+protocol_logger.setLevel(logging.INFO)
+
+
+# Prefixes messages with the connection they relate to
+class ConnectionLogger(logging.LoggerAdapter):
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = dict(self.extra, **kwargs.get('extra', {}))
+        return '[{}] {}'.format(self.extra['connection'], msg), kwargs
+
+    # Quarry still uses the deprecated warn()
+    def warn(self, msg, *args, **kwargs):
+        self.warning(msg, *args, **kwargs)
@@ -0,0 +1,533 @@
+import glob
+import os
+import shutil
+import struct
+import sys
+from collections import defaultdict
+from typing import List, Optional, Tuple, Dict
+
+from waitingserver.archive import parse_packet_filename
+
+# Lossless re-encoding of level_chunk_with_light and light_update packets
+#
+# Paletted containers are rewritten with only the palette entries they use, at the smallest bit width the client
+# accepts, and as a single value where a section (or its biomes) only contains one. Direct (global palette) containers
+# that need more than 8 bits are left as they are, as their width depends on the size of the client's registries.
+# Light arrays containing only zeros are replaced by the matching bit in the empty light masks.
+# Sections can't be dropped, as the client expects one for every section in the dimension's height. Heightmaps and
+# block entities are copied as they are.
+#
+# Chunk formats:
+# 1.21 - 1.21.4:  heightmaps are NBT, container data arrays are prefixed with their length in longs
+# 1.21.5+:        heightmaps are prefixed arrays of longs, container data arrays have no length prefix
+# 26.1+:          sections have a fluid count after the block count
+#
+# Usage:
+# python -m waitingserver.optimize [packets folder] [output folder]  Write an optimized copy of the corpus
+# python -m waitingserver.optimize --verify [packets folder] [output folder]  Check an optimized copy decodes the same
+
+CHUNK_PACKETS = ('level_chunk_with_light', 'light_update')
+DATA_LENGTH_REMOVED = (1, 21, 5)  # First format without data array length prefixes
+FLUID_COUNT_ADDED = (26, 1)  # First format with section fluid counts
+
+SECTION_BLOCKS = 4096
+SECTION_BIOMES = 64
+LIGHT_ARRAY_SIZE = 2048
+EMPTY_LIGHT = bytes(LIGHT_ARRAY_SIZE)
+
+
+class Reader:
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt: str):
+        value = struct.unpack_from('>' + fmt, self.data, self.pos)
+        self.pos += struct.calcsize('>' + fmt)
+
+        return value[0] if len(value) == 1 else value
+
+    def read(self, length: int) -> bytes:
+        value = bytes(self.data[self.pos:self.pos + length])
+
+        if len(value) != length:
+            raise ValueError('Unexpected end of packet')
+
+        self.pos += length
+        return value
+
+    def unpack_varint(self) -> int:
+        number = 0
+
+        for i in range(0, 5):
+            byte = self.data[self.pos]
+            self.pos += 1
+            number |= (byte & 0x7F) << (7 * i)
+
+            if not byte & 0x80:
+                return number
+
+        raise ValueError('Varint too long')
+
+    def unpack_longs(self, count: int) -> List[int]:
+        longs = list(struct.unpack_from('>{}Q'.format(count), self.data, self.pos))
+        self.pos += count * 8
+
+        return longs
+
+    # Skip a network NBT tag (no root name), returning its bytes
+    def read_nbt(self) -> bytes:
+        start = self.pos
+        tag = self.unpack('B')
+
+        if tag != 0:
+            self.skip_nbt_payload(tag)
+
+        return bytes(self.data[start:self.pos])
+
+    def skip_nbt_payload(self, tag: int):
+        if tag in (1, 2, 3, 4, 5, 6):
+            length = (0, 1, 2, 4, 8, 4, 8)[tag]
+        elif tag == 7:
+            length = self.unpack('i')
+        elif tag == 8:
+            length = self.unpack('H')
+        elif tag == 9:
+            element, count = self.unpack('Bi')
+            length = 0
+
+            for i in range(0, count):
+                self.skip_nbt_payload(element)
+        elif tag == 10:
+            length = 0
+
+            while True:
+                element = self.unpack('B')
+
+                if element == 0:
+                    break
+
+                self.read(self.unpack('H'))
+                self.skip_nbt_payload(element)
+        elif tag == 11:
+            length = self.unpack('i') * 4
+        elif tag == 12:
+            length = self.unpack('i') * 8
+        else:
+            raise ValueError('Unknown NBT tag {}'.format(tag))
+
+        self.read(length)
+
+
+def pack_varint(number: int) -> bytes:
+    out = bytearray()
+
+    while True:
+        byte = number & 0x7F
+        number >>= 7
+
+        if number:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def pack_longs(longs: List[int]) -> bytes:
+    return struct.pack('>{}Q'.format(len(longs)), *longs)
+
+
+def pack_bitset(bits: List[int]) -> bytes:
+    longs = []
+
+    for bit in bits:
+        while len(longs) <= bit // 64:
+            longs.append(0)
+
+        longs[bit // 64] |= 1 << (bit % 64)
+
+    return pack_varint(len(longs)) + pack_longs(longs)
+
+
+def unpack_bitset(reader: Reader) -> List[int]:
+    longs = reader.unpack_longs(reader.unpack_varint())
+
+    return [i * 64 + bit for i, value in enumerate(longs) for bit in range(0, 64) if value >> bit & 1]
+
+
+# Bits per entry the client uses for a container, given the bits it was sent with
+# Blocks use at least 4 bits with a palette, biomes have no minimum. Larger widths use the global palette.
+def get_container_bits(bits: int, biomes: bool) -> Tuple[int, bool]:
+    if bits == 0:
+        return 0, True
+
+    if biomes:
+        return bits, bits <= 3
+
+    return max(bits, 4), bits <= 8
+
+
+def unpack_values(longs: List[int], bits: int, size: int) -> List[int]:
+    per_long = 64 // bits
+    mask = (1 << bits) - 1
+    shifts = [i * bits for i in range(0, per_long)]
+    values = [(value >> shift) & mask for value in longs for shift in shifts]
+
+    return values[:size]
+
+
+def pack_values(values: List[int], bits: int) -> List[int]:
+    per_long = 64 // bits
+    longs = []
+
+    for i in range(0, len(values), per_long):
+        value = 0
+
+        for j, entry in enumerate(values[i:i + per_long]):
+            value |= entry << (j * bits)
+
+        longs.append(value)
+
+    return longs
+
+
+class Container:
+
+    def __init__(self, bits: int, palette: Optional[List[int]], longs: List[int], raw: bytes):
+        self.bits = bits  # As sent, 0 for a single value
+        self.palette = palette  # None for the global palette
+        self.longs = longs
+        self.raw = raw  # Original encoding
+
+    def get_values(self, size: int, biomes: bool) -> List[int]:
+        if self.bits == 0:
+            return [self.palette[0]] * size
+
+        bits, indirect = get_container_bits(self.bits, biomes)
+        values = unpack_values(self.longs, bits, size)
+
+        return [self.palette[value] for value in values] if indirect else values
+
+
+def read_container(reader: Reader, size: int, biomes: bool, length_prefix: bool) -> Container:
+    start = reader.pos
+    bits = reader.unpack('B')
+    config_bits, indirect = get_container_bits(bits, biomes)
+
+    if bits == 0:
+        palette = [reader.unpack_varint()]
+    elif indirect:
+        palette = [reader.unpack_varint() for i in range(0, reader.unpack_varint())]
+    else:
+        palette = None
+
+    if length_prefix:
+        count = reader.unpack_varint()
+    else:
+        count = 0 if bits == 0 else -(-size // (64 // config_bits))
+
+    longs = reader.unpack_longs(count)
+
+    return Container(bits, palette, longs, bytes(reader.data[start:reader.pos]))
+
+
+# Smallest encoding of a container's values, or the original encoding if that is no larger
+def write_container(container: Container, size: int, biomes: bool, length_prefix: bool) -> bytes:
+    values = container.get_values(size, biomes)
+    palette = list(dict.fromkeys(values))  # Used values, in order of first use
+
+    if len(palette) == 1:
+        encoded = b'\x00' + pack_varint(palette[0]) + (pack_varint(0) if length_prefix else b'')
+    else:
+        bits = max(1, (len(palette) - 1).bit_length())
+        bits, indirect = get_container_bits(bits, biomes)
+
+        if not indirect:
+            return container.raw
+
+        indexes = {value: i for i, value in enumerate(palette)}
+        longs = pack_values([indexes[value] for value in values], bits)
+
+        encoded = bytes([bits]) + pack_varint(len(palette)) + b''.join(pack_varint(value) for value in palette) \
+            + (pack_varint(len(longs)) if length_prefix else b'') + pack_longs(longs)
+
+    return encoded if len(encoded) < len(container.raw) else container.raw
+
+
+class Light:
+
+    def __init__(self, sky: Dict[int, Optional[bytes]], block: Dict[int, Optional[bytes]]):
+        # Section index -> light array, or None for an empty (all zero) section
+        # Sections with no light data are absent
+        self.sky = sky
+        self.block = block
+
+
+def read_light(reader: Reader) -> Light:
+    sky_mask = unpack_bitset(reader)
+    block_mask = unpack_bitset(reader)
+    empty_sky_mask = unpack_bitset(reader)
+    empty_block_mask = unpack_bitset(reader)
+
+    sky = {index: None for index in empty_sky_mask}
+    block = {index: None for index in empty_block_mask}
+
+    for mask, arrays in ((sky_mask, sky), (block_mask, block)):
+        count = reader.unpack_varint()
+
+        if count != len(mask):
+            raise ValueError('Light array count does not match mask')
+
+        for index in mask:
+            arrays[index] = reader.read(reader.unpack_varint())
+
+    return light_normalized(Light(sky, block))
+
+
+# Arrays of zeros are equivalent to the empty mask
+def light_normalized(light: Light) -> Light:
+    for arrays in (light.sky, light.block):
+        for index, array in arrays.items():
+            if array == EMPTY_LIGHT:
+                arrays[index] = None
+
+    return light
+
+
+def write_light(light: Light) -> bytes:
+    sky = sorted(index for index, array in light.sky.items() if array is not None)
+    block = sorted(index for index, array in light.block.items() if array is not None)
+    empty_sky = sorted(index for index, array in light.sky.items() if array is None)
+    empty_block = sorted(index for index, array in light.block.items() if array is None)
+
+    out = [pack_bitset(sky), pack_bitset(block), pack_bitset(empty_sky), pack_bitset(empty_block)]
+
+    for indexes, arrays in ((sky, light.sky), (block, light.block)):
+        out.append(pack_varint(len(indexes)))
+
+        for index in indexes:
+            out.append(pack_varint(len(arrays[index])) + arrays[index])
+
+    return b''.join(out)
+
+
+class Section:
+
+    def __init__(self, counts: bytes, blocks: Container, biomes: Container):
+        self.counts = counts  # Non-air block count, and fluid count from 26.1
+        self.blocks = blocks
+        self.biomes = biomes
+
+
+class ChunkPacket:
+
+    def __init__(self, header: bytes, heightmaps: bytes, sections: List[Section], padding: bytes,
+                 block_entities: bytes, light: Light, length_prefix: bool):
+        self.header = header  # Chunk coordinates
+        self.heightmaps = heightmaps
+        self.sections = sections
+        self.padding = padding  # Trailing zeros after the sections, which the client doesn't read
+        self.block_entities = block_entities
+        self.light = light
+        self.length_prefix = length_prefix
+
+
+def read_heightmaps(reader: Reader, length_prefix: bool) -> bytes:
+    start = reader.pos
+
+    if length_prefix:
+        reader.read_nbt()
+    else:
+        for i in range(0, reader.unpack_varint()):
+            reader.unpack_varint()  # Type
+            reader.unpack_longs(reader.unpack_varint())
+
+    return bytes(reader.data[start:reader.pos])
+
+
+def read_chunk_packet(data: bytes, packet_type: str, chunk_format: str) -> ChunkPacket:
+    reader = Reader(data)
+    version = tuple(int(part) for part in chunk_format.split('.'))
+    length_prefix = version < DATA_LENGTH_REMOVED
+    counts_length = 4 if version >= FLUID_COUNT_ADDED else 2
+
+    if packet_type == 'light_update':
+        reader.unpack_varint()
+        reader.unpack_varint()
+        header = bytes(data[:reader.pos])
+
+        return finish_read(reader, ChunkPacket(header, b'', [], b'', b'', read_light(reader), length_prefix))
+
+    header = reader.read(8)
+    heightmaps = read_heightmaps(reader, length_prefix)
+
+    sections_reader = Reader(reader.read(reader.unpack_varint()))
+    sections = []
+
+    padding = b''
+
+    while sections_reader.pos < len(sections_reader.data):
+        start = sections_reader.pos
+
+        try:
+            counts = sections_reader.read(counts_length)
+            blocks = read_container(sections_reader, SECTION_BLOCKS, False, length_prefix)
+            biomes = read_container(sections_reader, SECTION_BIOMES, True, length_prefix)
+        except (ValueError, IndexError, struct.error):
+            # 1.21.5 sizes the section data as if the data arrays still had length prefixes, leaving zeros at the
+            # end which are too short to be a section
+            padding = bytes(sections_reader.data[start:])
+
+            if padding.count(0) != len(padding):
+                raise
+
+            break
+
+        sections.append(Section(counts, blocks, biomes))
+
+    start = reader.pos
+
+    for i in range(0, reader.unpack_varint()):
+        reader.read(3)  # Packed xz, y
+        reader.unpack_varint()  # Type
+        reader.read_nbt()
+
+    block_entities = bytes(data[start:reader.pos])
+
+    return finish_read(reader, ChunkPacket(header, heightmaps, sections, padding, block_entities, read_light(reader),
+                                           length_prefix))
+
+
+def finish_read(reader: Reader, packet: ChunkPacket) -> ChunkPacket:
+    if reader.pos != len(reader.data):
+        raise ValueError('{} unexpected bytes at end of packet'.format(len(reader.data) - reader.pos))
+
+    return packet
+
+
+def write_chunk_packet(packet: ChunkPacket, packet_type: str) -> bytes:
+    if packet_type == 'light_update':
+        return packet.header + write_light(packet.light)
+
+    sections = b''.join(section.counts
+                        + write_container(section.blocks, SECTION_BLOCKS, False, packet.length_prefix)
+                        + write_container(section.biomes, SECTION_BIOMES, True, packet.length_prefix)
+                        for section in packet.sections) + packet.padding
+
+    return packet.header + packet.heightmaps + pack_varint(len(sections)) + sections + packet.block_entities \
+        + write_light(packet.light)
+
+
+# Decoded contents of a chunk packet, for comparing encodings
+def decode_chunk_packet(data: bytes, packet_type: str, chunk_format: str) -> tuple:
+    packet = read_chunk_packet(data, packet_type, chunk_format)
+    sections = [(section.counts, section.blocks.get_values(SECTION_BLOCKS, False),
+                 section.biomes.get_values(SECTION_BIOMES, True)) for section in packet.sections]
+
+    return packet.header, packet.heightmaps, sections, packet.padding, packet.block_entities, packet.light.sky, \
+        packet.light.block
+
+
+def optimize_packet(data: bytes, packet_type: str, chunk_format: str) -> bytes:
+    optimized = write_chunk_packet(read_chunk_packet(data, packet_type, chunk_format), packet_type)
+
+    if len(optimized) >= len(data):
+        return data
+
+    if decode_chunk_packet(optimized, packet_type, chunk_format) != decode_chunk_packet(data, packet_type,
+                                                                                        chunk_format):
+        raise ValueError('Optimized packet does not match the original')
+
+    return optimized
+
+
+# Files in the corpus, as (world folder, chunk format, file name)
+def get_packet_files(packets_folder: str) -> List[Tuple[str, str, str]]:
+    files = []
+
+    for filename in sorted(glob.glob(os.path.join(packets_folder, '*', '*', '*.bin'))):
+        folder, chunk_format = os.path.split(os.path.dirname(filename))
+        files.append((os.path.basename(folder), chunk_format, filename))
+
+    return files
+
+
+def optimize(packets_folder: str, output_folder: str):
+    saved = defaultdict(int)
+    totals = defaultdict(int)
+
+    for world, chunk_format, filename in get_packet_files(packets_folder):
+        output = os.path.join(output_folder, os.path.relpath(filename, packets_folder))
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+        id, packet_type, dn, chunk = parse_packet_filename(filename)
+
+        if packet_type not in CHUNK_PACKETS:
+            shutil.copyfile(filename, output)
+            continue
+
+        with open(filename, 'rb') as file:
+            data = file.read()
+
+        try:
+            optimized = optimize_packet(data, packet_type, chunk_format)
+        except (ValueError, IndexError, struct.error) as e:
+            print('Copying {} unchanged: {}'.format(filename, e))
+            optimized = data
+
+        with open(output, 'wb') as file:
+            file.write(optimized)
+
+        totals[world] += len(data)
+        saved[world] += len(data) - len(optimized)
+
+    for world in sorted(totals):
+        print('{:<20} {:>12} chunk bytes {:>12} saved ({:.1f}%)'.format(
+            world, totals[world], saved[world], saved[world] / totals[world] * 100 if totals[world] else 0))
+
+    print('{} bytes saved in total'.format(sum(saved.values())))
+
+
+def verify(packets_folder: str, output_folder: str) -> bool:
+    failed = 0
+
+    for world, chunk_format, filename in get_packet_files(packets_folder):
+        output = os.path.join(output_folder, os.path.relpath(filename, packets_folder))
+        id, packet_type, dn, chunk = parse_packet_filename(filename)
+
+        with open(filename, 'rb') as file:
+            original = file.read()
+
+        with open(output, 'rb') as file:
+            optimized = file.read()
+
+        if packet_type in CHUNK_PACKETS:
+            matches = decode_chunk_packet(original, packet_type, chunk_format) \
+                      == decode_chunk_packet(optimized, packet_type, chunk_format)
+        else:
+            matches = original == optimized
+
+        if not matches:
+            print('Mismatch in {}'.format(output))
+            failed += 1
+
+    print('Verified with {} mismatches'.format(failed))
+
+    return failed == 0
+
+
+def main(argv: List[str]):
+    check = '--verify' in argv
+    args = [arg for arg in argv[1:] if arg != '--verify']
+    packets_folder = args[0] if len(args) > 0 else os.path.join(os.getcwd(), 'packets')
+    output_folder = args[1] if len(args) > 1 else os.path.join(os.getcwd(), 'packets-optimized')
+
+    if check:
+        sys.exit(0 if verify(packets_folder, output_folder) else 1)
+
+    optimize(packets_folder, output_folder)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
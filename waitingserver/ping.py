@@ -0,0 +1,98 @@
+import base64
+import time
+from typing import Dict, Optional, Tuple
+
+from quarry.data import packets
+
+from waitingserver.ratelimit import TokenBucket
+
+PING_BURST = 5  # Pings allowed from a single address before the rate limit applies
+MAX_TRACKED_HOSTS = 10000  # Addresses tracked by the rate limiter before full buckets are pruned
+
+
+# Encoded status responses, keyed by protocol version
+# A response is only rebuilt when the player count moves into another bucket or the motd changes, so pings from
+# proxies and scanners are answered with a single write of already framed bytes
+class StatusResponseCache:
+
+    def __init__(self):
+        self.bucket_size = 1
+        self.responses: Dict[int, Tuple[tuple, bytes]] = dict()
+        self.favicons: Dict[str, str] = dict()
+
+    def get_response(self, protocol, online: int) -> bytes:
+        factory = protocol.factory
+        state = (online // self.bucket_size, factory.motd, factory.max_players, factory.icon_path)
+        cached = self.responses.get(protocol.protocol_version)
+
+        if cached is None or cached[0] != state:
+            response = self.build_response(protocol, online)
+            cached = (state, protocol.frame_packet("status_response", protocol.buff_type.pack_json(response)))
+            self.responses[protocol.protocol_version] = cached
+
+        return cached[1]
+
+    # Matches the response built by quarry
+    def build_response(self, protocol, online: int) -> dict:
+        factory = protocol.factory
+        response = {
+            "description": {
+                "text": factory.motd
+            },
+            "players": {
+                "online": online,
+                "max": factory.max_players
+            },
+            "version": {
+                "name": packets.minecraft_versions.get(protocol.protocol_version, "???"),
+                "protocol": protocol.protocol_version,
+            }
+        }
+
+        if factory.icon_path is not None:
+            response["favicon"] = self.get_favicon(factory.icon_path)
+
+        return response
+
+    def get_favicon(self, path: str) -> str:
+        if path not in self.favicons:
+            with open(path, "rb") as file:
+                self.favicons[path] = "data:image/png;base64," + base64.b64encode(file.read()).decode('ascii')
+
+        return self.favicons[path]
+
+
+# Per address token bucket for status pings, disabled unless a rate is set
+class PingRateLimiter:
+
+    def __init__(self):
+        self.rate: Optional[float] = None  # Pings per second
+        self.buckets: Dict[str, TokenBucket] = dict()
+
+    def allow(self, host: str) -> bool:
+        if self.rate is None:
+            return True
+
+        bucket = self.buckets.get(host)
+
+        if bucket is None:
+            bucket = TokenBucket(self.rate, PING_BURST)
+            self.buckets[host] = bucket
+
+            if len(self.buckets) > MAX_TRACKED_HOSTS:
+                self.prune()
+
+        return bucket.consume()
+
+    # Forget addresses whose buckets have refilled, as they would be recreated in the same state
+    def prune(self):
+        now = time.monotonic()
+        refill = PING_BURST / self.rate
+
+        for host, bucket in list(self.buckets.items()):
+            if now - bucket.updated >= refill:
+                del self.buckets[host]
+
+
+status_cache = StatusResponseCache()
+ping_limiter = PingRateLimiter()
@@ -1,15 +1,145 @@
+import gc
 import logging
+import time
+from collections import deque
 
-from prometheus_client import start_http_server, Gauge
+from prometheus_client import start_http_server, Gauge, Histogram, Counter, CollectorRegistry, multiprocess
+from twisted.internet.task import LoopingCall
 
 # Create a metric to track time spent and requests made.
-players_online = Gauge('mc_players_online', 'Number of players connected to the server')
+# livesum combines the counts of each worker process in multi-process mode
+players_online = Gauge('mc_players_online', 'Number of players connected to the server', multiprocess_mode='livesum')
 
+join_queue_depth = Gauge('mc_join_queue_depth', 'Number of players waiting for a world send to start',
+                         multiprocess_mode='livesum')
+join_active = Gauge('mc_join_active', 'Number of world sends in progress', multiprocess_mode='livesum')
+join_wait = Histogram('mc_join_wait_seconds', 'Time spent queued before a world send starts',
+                      buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+
+# Stages are handshake, login, configuration, first_chunk and world_complete, each timed from the previous one
+join_stage = Histogram('mc_join_stage_seconds', 'Time taken by each stage of joining', ['stage'],
+                       buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+join_total = Histogram('mc_join_seconds', 'Time from connecting to the world being fully sent',
+                       buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+packets_sent = Counter('mc_packets_sent', 'Packets sent, by packet type', ['type'])
+bytes_sent = Counter('mc_bytes_sent', 'Bytes sent after framing and compression, by packet type', ['type'])
+
+players_by_version = Gauge('mc_players_by_version', 'Number of players connected, by protocol version',
+                           ['protocol_version', 'version'], multiprocess_mode='livesum')
+players_by_world = Gauge('mc_players_by_world', 'Number of players in each world, by chunk format',
+                         ['world', 'chunk_format'], multiprocess_mode='livesum')
+
+portal_transfers = Counter('mc_portal_transfers', 'Players sent to another server by a portal', ['destination'])
+status_hmac_failures = Counter('mc_status_hmac_failures', 'Status updates rejected due to an invalid HMAC')
+
+gc_pause = Histogram('mc_gc_pause_seconds', 'Time spent in garbage collection, by generation', ['generation'],
+                     buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1))
+gc_frozen = Gauge('mc_gc_frozen_objects', 'Objects moved out of garbage collection after loading',
+                  multiprocess_mode='livesum')
+gc_tracked = Gauge('mc_gc_tracked_objects', 'Objects awaiting collection, by generation', ['generation'],
+                   multiprocess_mode='livesum')
+
+startup_time = Gauge('mc_startup_seconds', 'Time taken to load the config, worlds and maps at startup',
+                     multiprocess_mode='max')
+
+GC_METRICS_INTERVAL = 5  # Seconds between recording garbage collection pauses
+
+gc_pauses = deque(maxlen=10000)  # (generation, seconds) of collections since they were last recorded
+gc_pause_generations = [gc_pause.labels(generation) for generation in range(0, 3)]
+gc_tracked_generations = [gc_tracked.labels(generation) for generation in range(0, 3)]
+
+# Label children for packet types, to avoid a labels() lookup per packet
+packet_counters = dict()
+
+
+# When running workers, metrics_dir is the directory the workers write their metrics to
+def init_prometheus(host, port, metrics_dir=None):
+    if metrics_dir is not None:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=metrics_dir)
+        start_http_server(port, host, registry=registry)
+    else:
+        start_http_server(port, host)
 
-def init_prometheus(host, port):
-    start_http_server(port, host)
     logging.getLogger(__name__).info(f'Prometheus client started on port {host}:{port}')
 
 
+def set_startup_time(seconds):
+    startup_time.set(seconds)
+
+
 def set_players_online(count):
     players_online.set(count)
+
+
+def set_join_queue(depth, active):
+    join_queue_depth.set(depth)
+    join_active.set(active)
+
+
+def observe_join_wait(seconds):
+    join_wait.observe(seconds)
+
+
+def observe_join_stage(stage, seconds):
+    join_stage.labels(stage).observe(seconds)
+
+
+def observe_join_total(seconds):
+    join_total.observe(seconds)
+
+
+def count_packet_sent(packet_type, size):
+    counters = packet_counters.get(packet_type)
+
+    if counters is None:
+        counters = (packets_sent.labels(packet_type), bytes_sent.labels(packet_type))
+        packet_counters[packet_type] = counters
+
+    counters[0].inc()
+    counters[1].inc(size)
+
+
+def change_players_by_version(protocol_version, version, amount):
+    players_by_version.labels(protocol_version, version).inc(amount)
+
+
+def change_players_by_world(world, chunk_format, amount):
+    players_by_world.labels(world, chunk_format).inc(amount)
+
+
+def count_portal_transfer(destination):
+    portal_transfers.labels(destination).inc()
+
+
+def count_status_hmac_failure():
+    status_hmac_failures.inc()
+
+
+# Time each collection with gc.callbacks, for every process recording metrics
+# The callback only records durations, as taking metric locks during a collection could deadlock. They are observed
+# later from the reactor. Collection counts are left to prometheus_client's GCCollector.
+def init_gc_metrics():
+    started = 0.0
+
+    def callback(phase, info):
+        nonlocal started
+
+        if phase == 'start':
+            started = time.perf_counter()
+        else:
+            gc_pauses.append((info['generation'], time.perf_counter() - started))
+
+    gc_frozen.set(gc.get_freeze_count())
+    gc.callbacks.append(callback)
+    LoopingCall(record_gc_metrics).start(GC_METRICS_INTERVAL, now=False)
+
+
+def record_gc_metrics():
+    while len(gc_pauses):
+        generation, seconds = gc_pauses.popleft()
+        gc_pause_generations[generation].observe(seconds)
+
+    for gauge, count in zip(gc_tracked_generations, gc.get_count()):
+        gauge.set(count)
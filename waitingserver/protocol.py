@@ -1,17 +1,38 @@
-import hmac
-import json
-from copy import deepcopy
+import struct
+import time
+from bisect import bisect_right
+from functools import lru_cache
+from typing import List, Optional, Tuple
 
 from quarry.net.server import ServerProtocol
-from quarry.types import chat
+from quarry.types.buffer import BufferUnderrun
 from quarry.types.uuid import UUID
 
-from waitingserver.log import file_handler, console_handler, logger
-from waitingserver.prometheus import set_players_online
+from waitingserver.log import logger, protocol_logger, ConnectionLogger
+from waitingserver.prometheus import set_players_online, observe_join_stage, observe_join_total, count_packet_sent, \
+    change_players_by_version
+from waitingserver.ping import status_cache, ping_limiter
+from waitingserver.ratelimit import TokenBucket
+from waitingserver.status import receive_status_update
+from waitingserver.workers import get_total_players, set_player_count
 
 worlds = list()
 
 versions = {}
+protocol_versions = []  # Keys of versions, sorted
+
+PACKET_RATE = 200  # Packets per second allowed from a client, well above what the vanilla client sends
+PACKET_BURST = 1000
+
+CORK_LIMIT = 256 * 1024  # Bytes queued while corked before they are written anyway
+
+position_struct = struct.Struct('>ddd')  # Position at the start of the movement packets
+
+movement_packets = {'move_player_pos', 'move_player_pos_rot'}
+
+# Frequent packets with nothing to do, dropped by the fast path unless a handler exists for them (see below)
+unhandled_packets = ('move_player_rot', 'move_player_status_only', 'client_tick_end', 'player_input', 'player_loaded',
+                     'swing', 'player_command', 'player_abilities', 'set_carried_item', 'chunk_batch_received')
 
 
 class Protocol(ServerProtocol):
@@ -26,16 +47,55 @@ class Protocol(ServerProtocol):
 
         self.is_bedrock = False
         self.version = None
+        self.view_distance = None
+
+        self.captured_packets = None
+
+        self.cork_depth = 0
+        self.corked: List[bytes] = []
+        self.corked_length = 0
+
+        self.connected_at = time.perf_counter()
+        self.last_join_stage = self.connected_at
+        self.join_stages = set()
 
-        self.logger.addHandler(console_handler)
-        self.logger.addHandler(file_handler)
+        self.packet_limiter = TokenBucket(PACKET_RATE, PACKET_BURST)
+
+        # Replaces quarry's per host logger, which would otherwise need its own handlers
+        self.logger = ConnectionLogger(protocol_logger, {
+            'connection': '{}:{}'.format(self.remote_addr.host, self.remote_addr.port)
+        })
+
+    # Fast path for the bulk of inbound traffic, ahead of quarry's dispatch
+    # Movement positions are read straight from the frame, and packets nothing here handles are dropped
+    def packet_received(self, buff, name):
+        if not self.packet_limiter.consume():
+            self.logger.warning("Closing connection after exceeding the packet rate limit")
+            self.close("Too many packets")
+            buff.discard()
+            return
+
+        if name in movement_packets:
+            if len(buff.buff) - buff.pos < position_struct.size:
+                raise BufferUnderrun()
+
+            if self.version is not None and self.version.current_world is not None:
+                self.version.player_moved(*position_struct.unpack_from(buff.buff, buff.pos))
+
+            buff.discard()
+        elif name in ignored_packets:
+            buff.discard()
+        else:
+            super().packet_received(buff, name)
 
     def packet_intention(self, buff):
-        buff2 = deepcopy(buff)
-        super().packet_intention(buff)
+        # Read the host for Floodgate, then rewind for quarry to handle the rest of the handshake
+        buff.save()
+        buff.unpack_varint()
+        p_connect_host = buff.unpack_string()
+        buff.restore()
 
-        buff2.unpack_varint()
-        p_connect_host = buff2.unpack_string()
+        super().packet_intention(buff)
 
         # Floodgate
         split_host = str.split(p_connect_host, "\00")
@@ -50,35 +110,60 @@ class Protocol(ServerProtocol):
                     self.connect_host = split_host[2]
                     self.uuid = split_host[3]
 
-        version = None
-
-        # Select version handler
-        for protocol_version, v in versions.items():
-            if self.protocol_version >= protocol_version:
-                version = v
+        version = get_version(self.protocol_version)
 
         if version is not None:
             self.version = version(self, self.is_bedrock)
         else:
             self.close("Unsupported Minecraft Version")
 
+        if self.protocol_mode == "status" and not ping_limiter.allow(self.remote_addr.host):
+            self.close()
+            return
+
+        if self.protocol_mode == "login":
+            self.mark_join_stage("handshake")
+
+    # Answer pings from the shared response cache, rather than building a response for each one
+    def packet_status_request(self, buff):
+        online = get_total_players()
+
+        if online is None:
+            online = len(self.factory.players)
+
+        self.send_framed("status_response", status_cache.get_response(self, online))
+
     def player_joined(self):
+        # Apply the player limit across all workers
+        total_players = get_total_players()
+
+        if total_players is not None and total_players >= self.factory.max_players:
+            self.close("Server is full")
+            return
+
         super().player_joined()
 
+        self.mark_join_stage("configuration")
         set_players_online(len(self.factory.players))
+        set_player_count(len(self.factory.players))
+        change_players_by_version(self.protocol_version, type(self.version).__name__, 1)
 
         self.version.player_joined()
 
     def player_left(self):
         super().player_left()
 
-        set_players_online(len(self.factory.players))
+        self.version.player_left()
 
-    def packet_move_player_pos(self, buff):
-        self.version.packet_move_player_pos(buff)
+        set_players_online(len(self.factory.players))
+        set_player_count(len(self.factory.players))
+        change_players_by_version(self.protocol_version, type(self.version).__name__, -1)
 
-    def packet_move_player_pos_rot(self, buff):
-        self.version.packet_move_player_pos_rot(buff)
+    # Sent during configuration, and again in game if the client's settings change
+    def packet_client_information(self, buff):
+        buff.unpack_string()  # Locale
+        self.view_distance = buff.unpack('b')
+        buff.discard()
 
     def packet_chat(self, buff):
         self.version.packet_chat(buff)
@@ -95,35 +180,108 @@ class Protocol(ServerProtocol):
             return
 
         if self.status_secret is None:
-            self.logger.warn("Ignoring status plugin message as no status secret is configured")
+            self.logger.warning("Ignoring status plugin message as no status secret is configured")
             return
 
-        payload = json.loads(data.decode(encoding="utf-8"))
-        payload_hmac = payload.get("hmac")
+        receive_status_update(self.factory, data, self.status_secret)
 
-        msg = payload.get("servers", "{}")
-        calculated_hmac = hmac.new(key=str.encode(self.status_secret, encoding="utf-8"),
-                                   msg=str.encode(msg, encoding="utf-8"), digestmod="sha512")
+    # Record the time taken by a stage of joining, since the previous stage
+    # Each stage is only recorded once per connection, so later world resets are ignored
+    def mark_join_stage(self, stage):
+        if stage in self.join_stages:
+            return
+
+        now = time.perf_counter()
+        self.join_stages.add(stage)
+        observe_join_stage(stage, now - self.last_join_stage)
+        self.last_join_stage = now
+
+        if stage == "world_complete":
+            observe_join_total(now - self.connected_at)
+
+    # Equivalent to quarry's send_packet, but split into framing and sending so the size can be recorded
+    def send_packet(self, name, *data):
+        if self.closed:
+            return
+
+        self.send_framed(name, self.frame_packet(name, *data))
+
+    # Frame and compress a packet without sending it, so the result can be cached and reused across connections
+    # Encryption is applied at send time, as cipher state is per connection
+    def frame_packet(self, name, *data):
+        data = self.buff_type.pack_varint(self.get_packet_ident(name)) + b"".join(data)
 
-        if calculated_hmac.hexdigest() != payload_hmac:
-            self.logger.warn("Failed to validate status plugin message. Is the status secret configured correctly?")
+        return self.buff_type.pack_packet(data, self.compression_threshold)
+
+    # Send a packet previously framed by frame_packet
+    def send_framed(self, name, data):
+        if self.closed:
+            return
+
+        if self.captured_packets is not None:
+            self.captured_packets.append((name, data))
             return
 
-        server_statuses = json.loads(msg)
-        self.factory.server_statuses = {}
+        self.log_packet(">", name)
+        count_packet_sent(name, len(data))
+
+        # Encrypted as it is queued, as the cipher is a stream and packets must be encrypted in the order they are sent
+        if self.cork_depth > 0:
+            self.corked.append(self.cipher.encrypt(data))
+            self.corked_length += len(data)
+
+            if self.corked_length >= CORK_LIMIT:
+                self.flush_corked()
+        else:
+            self.transport.write(self.cipher.encrypt(data))
+
+    # Queue packets sent until the matching uncork(), and write them to the transport together
+    # Calls may be nested, packets are written when the outermost uncork() is reached
+    def cork(self):
+        self.cork_depth += 1
 
-        for server, status in server_statuses.items():
-            combined_lines = status.get("combinedLines", None)
-            self.factory.server_statuses[server] = chat.Message(json.loads(combined_lines))
+    def uncork(self):
+        self.cork_depth -= 1
 
-        for player in self.factory.players:
-            if player.protocol_mode == "game":
-                player.version.send_status_hologram_texts()
+        if self.cork_depth == 0:
+            self.flush_corked()
+
+    def flush_corked(self):
+        if len(self.corked) and not self.closed:
+            self.transport.writeSequence(self.corked)
+
+        self.corked = []
+        self.corked_length = 0
+
+    # Send the packets sent by send in a single write
+    def send_corked(self, send):
+        self.cork()
+
+        try:
+            send()
+        finally:
+            self.uncork()
+
+    # Frames of the packets sent by send, which are returned instead of being sent
+    def capture_packets(self, send) -> List[Tuple[str, bytes]]:
+        self.captured_packets = []
+
+        try:
+            send()
+        finally:
+            captured, self.captured_packets = self.captured_packets, None
+
+        return captured
 
     def configuration(self):
+        self.mark_join_stage("login")
         self.data_packs.add_data_pack(self.version.get_data_pack())
         self.complete_configuration()
 
+# Packets which would only reach quarry's packet_unhandled, as neither quarry nor Protocol handles them
+ignored_packets = frozenset(name for name in unhandled_packets if not hasattr(Protocol, 'packet_' + name))
+
+
 # Build dictionary of protocol version -> version class
 # Local import to prevent circular import issues
 def build_versions():
@@ -132,3 +290,19 @@ def build_versions():
     for version in vars(waitingserver.versions).values():
         if hasattr(version, 'protocol_version') and version.protocol_version is not None:
             versions[version.protocol_version] = version
+            version.prepare_maps()
+
+    protocol_versions[:] = sorted(versions)
+    get_version.cache_clear()
+
+
+# Version class for a client's protocol version, the newest version not above it
+# Cached with a bounded size, as the protocol version in a handshake can be anything
+@lru_cache(maxsize=256)
+def get_version(protocol_version: int) -> Optional[type]:
+    index = bisect_right(protocol_versions, protocol_version)
+
+    if index == 0:
+        return None
+
+    return versions[protocol_versions[index - 1]]
@@ -0,0 +1,135 @@
+import hashlib
+import hmac
+import json
+import time
+from typing import Callable, Dict, Optional, Set
+
+from quarry.types import chat
+from twisted.internet import reactor
+from twisted.internet.protocol import DatagramProtocol
+from twisted.protocols.basic import Int32StringReceiver
+
+from waitingserver.log import logger
+from waitingserver.prometheus import count_status_hmac_failure
+
+STATUS_INTERVAL = 1.0  # Minimum seconds between handling pushed status updates
+
+last_digest: Optional[bytes] = None  # Digest of the last accepted update, to skip repeats relayed by other proxies
+status_sources: Dict[str, str] = dict()  # Server -> raw combinedLines of its current status
+
+
+# Validate a signed status update and apply it to factory.server_statuses
+# Only servers whose status has changed are re-sent, and only to players in a world with a hologram for them
+def receive_status_update(factory, data: bytes, secret: str) -> bool:
+    global last_digest
+
+    payload = json.loads(data.decode(encoding="utf-8"))
+    payload_hmac = payload.get("hmac")
+
+    msg = payload.get("servers", "{}")
+    calculated_hmac = hmac.new(key=str.encode(secret, encoding="utf-8"),
+                               msg=str.encode(msg, encoding="utf-8"), digestmod="sha512")
+
+    if not isinstance(payload_hmac, str) or not hmac.compare_digest(calculated_hmac.hexdigest(), payload_hmac):
+        logger.warning("Failed to validate status message. Is the status secret configured correctly?")
+        count_status_hmac_failure()
+        return False
+
+    digest = hashlib.sha256(str.encode(msg, encoding="utf-8")).digest()
+
+    if digest == last_digest:
+        return True
+
+    last_digest = digest
+    changed = apply_server_statuses(factory, json.loads(msg))
+
+    if len(changed):
+        send_server_statuses(factory, changed)
+
+    return True
+
+
+# Update factory.server_statuses, returning the servers whose status has changed
+def apply_server_statuses(factory, server_statuses: dict) -> Set[str]:
+    changed = set()
+
+    for server, status in server_statuses.items():
+        combined_lines = status.get("combinedLines", None)
+
+        if status_sources.get(server) != combined_lines:
+            status_sources[server] = combined_lines
+            factory.server_statuses[server] = chat.Message(json.loads(combined_lines))
+            changed.add(server)
+
+    for server in list(status_sources):
+        if server not in server_statuses:
+            del status_sources[server]
+            factory.server_statuses.pop(server, None)
+
+    return changed
+
+
+def send_server_statuses(factory, servers: Set[str]):
+    for player in factory.players:
+        if player.protocol_mode != "game":
+            continue
+
+        world = player.version.current_world
+
+        if world is not None and not servers.isdisjoint(world.hologram_servers):
+            player.version.send_status_hologram_texts(servers)
+
+
+# Local status listener, accepting the same signed payload as the serverstatus:status plugin message over UDP
+# Pushes are coalesced, so at most one update is handled per interval and only the latest payload is kept
+class StatusListener(DatagramProtocol):
+
+    def __init__(self, handler: Callable[[bytes], None], interval: float = STATUS_INTERVAL):
+        self.handler = handler
+        self.interval = interval
+        self.pending: Optional[bytes] = None
+        self.last_handled = 0.0
+        self.call = None
+
+    def datagramReceived(self, data: bytes, addr):
+        self.pending = data
+
+        if self.call is None:
+            delay = max(0.0, self.last_handled + self.interval - time.monotonic())
+            self.call = reactor.callLater(delay, self.flush)
+
+    def flush(self):
+        data = self.pending
+
+        self.call = None
+        self.pending = None
+        self.last_handled = time.monotonic()
+
+        try:
+            self.handler(data)
+        except Exception:
+            logger.exception('Failed to handle status update')
+
+
+# Receives status updates relayed from the supervisor over stdin, when running as a worker
+class StatusRelayReceiver(Int32StringReceiver):
+    MAX_LENGTH = 65535
+
+    def __init__(self, factory, secret: Optional[str]):
+        self.factory = factory
+        self.secret = secret
+
+    def stringReceived(self, data: bytes):
+        try:
+            handle_status_update(self.factory, data, self.secret)
+        except Exception:
+            logger.exception('Failed to handle status update')
+
+
+# Handle a status update received outside of a player's connection
+def handle_status_update(factory, data: bytes, secret: Optional[str]):
+    if secret is None:
+        logger.warning("Ignoring status update as no status secret is configured")
+        return
+
+    receive_status_update(factory, data, secret)
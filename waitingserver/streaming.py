@@ -0,0 +1,160 @@
+import time
+from collections import deque
+from typing import List, Callable, Optional, Deque
+
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
+from zope.interface import implementer
+
+from waitingserver.prometheus import set_join_queue, observe_join_wait
+from waitingserver.world import WorldPacket
+
+BATCH_SIZE = 128 * 1024  # Bytes of world packets to write per reactor turn
+
+
+# Limits how many world streams run at once, queueing the rest in the order they were started
+# Queued players are in game and receive keep alives as normal, they just see the loading screen for longer
+class StreamScheduler:
+
+    def __init__(self):
+        self.limit: Optional[int] = None  # None for no limit
+        self.active = 0
+        self.queue: Deque['WorldStream'] = deque()
+
+    def submit(self, stream: 'WorldStream'):
+        if self.limit is None or self.active < self.limit:
+            self.active += 1
+            stream.begin()
+        else:
+            stream.queued_at = time.time()
+            self.queue.append(stream)
+
+        self.update_metrics()
+
+    def release(self):
+        self.active -= 1
+
+        while len(self.queue) and (self.limit is None or self.active < self.limit):
+            stream = self.queue.popleft()
+            observe_join_wait(time.time() - stream.queued_at)
+            stream.queued_at = None
+
+            self.active += 1
+            stream.begin()
+
+        self.update_metrics()
+
+    def remove(self, stream: 'WorldStream'):
+        self.queue.remove(stream)
+        self.update_metrics()
+
+    def update_metrics(self):
+        set_join_queue(len(self.queue), self.active)
+
+
+scheduler = StreamScheduler()
+
+
+# Streams world packets to a client in batches, yielding to the reactor between each one
+# Registered as a producer with the transport, so writing pauses while the transport's buffer is full
+@implementer(IPushProducer)
+class WorldStream:
+
+    def __init__(self, protocol, packets: List[WorldPacket], on_complete: Callable[[], None]):
+        self.protocol = protocol
+        self.packets = packets
+        self.on_complete = on_complete
+
+        self.index = 0
+        self.queued_at: Optional[float] = None
+        self.active = False
+        self.paused = False
+        self.stopped = False
+        self.call = None
+
+    # Queue the stream with the scheduler, which calls begin() once there is capacity
+    def start(self):
+        scheduler.submit(self)
+
+    def begin(self):
+        if self.protocol.closed:
+            self.stopped = True
+            scheduler.release()
+            return
+
+        self.active = True
+        self.protocol.transport.registerProducer(self, True)
+        self.schedule()
+
+    # Stop streaming without completing, i.e. when the world is being reset or the player has left
+    def cancel(self):
+        if self.stopped:
+            return
+
+        active = self.active
+        self.stopProducing()
+
+        if active:
+            self.protocol.transport.unregisterProducer()
+
+    # Give up the stream's place in the scheduler, whether it is running or queued
+    def end(self):
+        if self.active:
+            self.active = False
+            scheduler.release()
+        elif self.queued_at is not None:
+            self.queued_at = None
+            scheduler.remove(self)
+
+    def schedule(self):
+        if self.call is None and not self.paused and not self.stopped:
+            self.call = reactor.callLater(0, self.send_batch)
+
+    def send_batch(self):
+        self.call = None
+        written = 0
+
+        if self.index == 0:
+            self.protocol.mark_join_stage("first_chunk")
+
+        # Each batch is written to the transport at once
+        self.protocol.cork()
+
+        try:
+            while self.index < len(self.packets) and written < BATCH_SIZE and not self.paused and not self.stopped:
+                packet = self.packets[self.index]
+                framed = packet.get_framed(self.protocol)
+
+                self.protocol.send_framed(packet.type, framed)
+                self.index += 1
+                written += len(framed)
+        finally:
+            self.protocol.uncork()
+
+        if self.stopped:
+            return
+
+        if self.index < len(self.packets):
+            self.schedule()
+            return
+
+        self.stopped = True
+        self.protocol.transport.unregisterProducer()
+        self.end()
+        self.on_complete()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.schedule()
+
+    def stopProducing(self):
+        self.stopped = True
+
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+        self.end()
@@ -0,0 +1,79 @@
+import random
+from typing import Callable, Dict, List, Hashable
+
+from twisted.internet.task import LoopingCall
+
+from waitingserver.log import logger
+
+TICK_LENGTH = 0.05  # Seconds per tick, matching quarry's ticker
+
+
+# Runs a callback for each registered connection once per interval
+# Connections are spread randomly over the slots of the wheel, so a burst of joins doesn't make their timers fire
+# in lockstep, and each tick only visits the connections in one slot
+class TimerWheel:
+
+    def __init__(self, interval: int):
+        self.interval = interval  # Ticks
+        self.slots: List[Dict[Hashable, Callable[[], None]]] = [dict() for i in range(0, interval)]
+        self.positions: Dict[Hashable, int] = dict()
+        self.tick = 0
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, key: Hashable, callback: Callable[[], None]):
+        self.remove(key)
+
+        slot = self.next_slot()
+        self.slots[slot][key] = callback
+        self.positions[key] = slot
+
+        scheduler.start()
+
+    def next_slot(self) -> int:
+        return random.randrange(0, self.interval)
+
+    def remove(self, key: Hashable):
+        slot = self.positions.pop(key, None)
+
+        if slot is not None:
+            del self.slots[slot][key]
+
+    def advance(self):
+        self.tick = (self.tick + 1) % self.interval
+
+        # Copied as callbacks may remove themselves, i.e. if sending fails and closes the connection
+        for callback in list(self.slots[self.tick].values()):
+            try:
+                callback()
+            except Exception:
+                logger.exception('Error in timer callback')
+
+
+# Advances every wheel from a single looping call
+class TimerScheduler:
+
+    def __init__(self):
+        self.wheels: List[TimerWheel] = []
+        self.loop = LoopingCall(self.advance)
+
+    def add_wheel(self, interval: int) -> TimerWheel:
+        wheel = TimerWheel(interval)
+        self.wheels.append(wheel)
+
+        return wheel
+
+    def start(self):
+        if not self.loop.running:
+            self.loop.start(TICK_LENGTH, now=False)
+
+    def advance(self):
+        for wheel in self.wheels:
+            wheel.advance()
+
+
+scheduler = TimerScheduler()
+
+keep_alive_timer = scheduler.add_wheel(100)
+music_timer = scheduler.add_wheel(200)
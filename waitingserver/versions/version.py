@@ -5,16 +5,22 @@ from copy import deepcopy
 from pathlib import Path
 
 from quarry.types import chat
-from typing import List, Dict, Tuple, Union, Optional
+from typing import List, Dict, Tuple, Union, Optional, Callable, Set
 
 from quarry.types.chat import Message
 from quarry.types.data_pack import DataPack
+from quarry.types.namespaced_key import NamespacedKey
+from twisted.internet.task import cooperate
 
 from waitingserver.Map import Map, MapPart
 from waitingserver.direction import Direction
 from waitingserver.protocol import Protocol
 from waitingserver.config import get_default_world, worlds, maps
+from waitingserver.streaming import WorldStream
+from waitingserver.timers import keep_alive_timer, music_timer
 from waitingserver.voting import entry_component, entry_navigation_component
+from waitingserver.prometheus import change_players_by_world, count_portal_transfer
+from waitingserver.world import World, WorldPacket
 
 parent_folder = Path(__file__).parent.parent
 
@@ -29,7 +35,10 @@ class Version(object, metaclass=abc.ABCMeta):
     map_entity_id = None # Entity ID to use when creating maps
     map_item_id = None # Item ID to use for the maps themselves
 
-    map_packets = dict() # Map packet cache
+    data_packs: Dict[int, Optional[DataPack]] = dict() # Data pack cache, by protocol version
+    dimension_ids: Dict[Tuple[int, NamespacedKey], int] = dict() # Dimension registry id cache
+    packet_cache: Dict[tuple, List[Tuple[str, bytes]]] = dict() # Encoded packets shared between connections
+    status_metadata: Dict[Tuple[int, str], Tuple[Message, bytes]] = dict() # Encoded status hologram metadata cache
 
     def __init__(self, protocol: Protocol, bedrock: bool = False):
         self.protocol = protocol
@@ -38,6 +47,7 @@ class Version(object, metaclass=abc.ABCMeta):
 
         self.last_portal = 0
         self.last_command = 0
+        self.last_block: Optional[Tuple[int, int, int]] = None  # Last block position checked for portals and bounds
 
         self.is_bedrock = bedrock
 
@@ -45,50 +55,77 @@ class Version(object, metaclass=abc.ABCMeta):
         self.status_holograms = dict()
         self.commands = {}
 
+        self.world_stream: Optional[WorldStream] = None
+        self.world_entities_start = self.last_entity_id  # First entity id spawned for the current world
+        self.sent_chunks: Set[Tuple[int, int]] = set()  # Chunks of the current world the client has been sent
+        self.reset_pending = False  # Respawn sent, world not yet sent again
+
     def player_joined(self):
-        self.protocol.ticker.add_loop(100, self.send_keep_alive)  # Keep alive packets
-        self.protocol.ticker.add_loop(200, lambda: self.send_music(True))
+        # Keep alive packets and music stops, run from shared timers for all connections
+        keep_alive_timer.add(self, lambda: self.send_cached(('keep_alive',), self.send_keep_alive))
+        music_timer.add(self, lambda: self.send_cached_music(True))
 
         if self.protocol.voting_mode:
-            self.current_world = worlds[self.chunk_format][0]
+            world = worlds[self.chunk_format][0]
         else:
-            self.current_world = get_default_world(self.chunk_format)
+            world = get_default_world(self.chunk_format)
 
-        if self.current_world is None:
+        if world is None:
             self.protocol.close('No defined worlds compatible with current client version')
             return
 
-        self.send_join_game()
-        self.send_commands()
-        self.send_world()
+        self.change_world(world)
+        self.protocol.cork()
+
+        try:
+            self.send_cached(('join_game', self.current_world), self.send_join_game)
+            self.send_cached(('commands',), self.send_commands)
+            self.send_world()
 
-        if self.is_bedrock:  # Prevent geyser persisting previous server inventory
-            self.send_inventory()
+            if self.is_bedrock:  # Prevent geyser persisting previous server inventory
+                self.send_cached(('inventory',), self.send_inventory)
+        finally:
+            self.protocol.uncork()
 
         self.protocol.ticker.add_delay(10, self.send_tablist)
-        self.protocol.ticker.add_delay(20, self.send_music)
+        self.protocol.ticker.add_delay(20, self.send_cached_music)
+
+    def player_left(self):
+        # Free up the player's place in the world send queue
+        if self.world_stream is not None:
+            self.world_stream.cancel()
+            self.world_stream = None
 
-    def packet_move_player_pos(self, buff):
-        x = buff.unpack('d')
-        y = buff.unpack('d')
-        z = buff.unpack('d')
+        keep_alive_timer.remove(self)
+        music_timer.remove(self)
 
-        buff.unpack('b')  # on_ground
+        self.change_world(None)
 
-        self.check_portals(x, y, z)
-        self.check_bounds(x, y, z)
+    def change_world(self, world: Optional[World]):
+        if self.current_world is not None:
+            change_players_by_world(self.current_world.name, self.chunk_format, -1)
 
-    def packet_move_player_pos_rot(self, buff):
-        x = buff.unpack('d')
-        y = buff.unpack('d')
-        z = buff.unpack('d')
+        if world is not None:
+            change_players_by_world(world.name, self.chunk_format, 1)
 
-        buff.unpack('f')  # yaw
-        buff.unpack('f')  # pitch
-        buff.unpack('b')  # on_ground
+        self.current_world = world
+        self.last_block = None
 
-        self.check_portals(x, y, z)
-        self.check_bounds(x, y, z)
+    # Called by the protocol's movement fast path with the decoded position
+    # Portals and world bounds are whole blocks, so moves within the last checked block can't change the result
+    def player_moved(self, x: float, y: float, z: float):
+        block = (math.floor(x), math.floor(y), math.floor(z))
+
+        if block == self.last_block:
+            return
+
+        # Both are checked, as a player in a portal during its cooldown may still be leaving the bounds
+        in_portal = self.check_portals(x, y, z)
+        out_of_bounds = self.check_bounds(x, y, z)
+
+        # Not remembered when a portal or the bounds are hit, so the checks run again if the player stays put
+        if not in_portal and not out_of_bounds:
+            self.last_block = block
 
     # Handle /spawn and /reset commands
     def packet_chat(self, buff):
@@ -133,24 +170,56 @@ class Version(object, metaclass=abc.ABCMeta):
 
         self.last_command = time.time()
 
-    def check_bounds(self, x, y, z):
+    # Returns whether the player was out of bounds
+    def check_bounds(self, x, y, z) -> bool:
         if not self.current_world.is_within_bounds(x, y, z):
             self.spawn_player(True)
+            return True
 
-    def check_portals(self, x, y, z):
+        return False
+
+    # Returns whether the player is in a portal
+    def check_portals(self, x, y, z) -> bool:
         server = self.current_world.get_portal_at(x, y, z)
         now = time.time()
 
         if server is not None and now - self.last_portal > 3:
             self.last_portal = now
-            self.protocol.logger.info("Sending %s to %s.", self.protocol.display_name, server)
+            self.protocol.logger.info("Sending %s to %s.", self.protocol.display_name, server,
+                                      extra={'sampled': True})
             self.send_portal(server)
+            count_portal_transfer(server)
+
+        return server is not None
 
     def send_world(self):
-        # Chunk packets
-        for packet in self.current_world.packets:
-            self.protocol.send_packet(packet.type, packet.data)
+        if self.world_stream is not None:
+            self.world_stream.cancel()
 
+        self.reset_pending = False
+        packets, deferred = self.current_world.get_packets(self.protocol.view_distance)
+
+        # Chunk packets, streamed over multiple reactor turns. The rest of the world is sent once they are done.
+        self.world_stream = WorldStream(self.protocol, packets, lambda: self.finish_world(packets, deferred))
+        self.world_stream.start()
+
+    def finish_world(self, packets: List[WorldPacket], deferred: List[WorldPacket]):
+        self.world_stream = None
+        self.add_sent_chunks(packets)
+        self.protocol.send_corked(self.send_world_entities)
+        self.protocol.mark_join_stage("world_complete")
+
+        if self.protocol.voting_mode:
+            self.prefetch_neighbours()
+
+        # Chunks outside the client's view distance of spawn, in case the player walks towards them
+        if len(deferred):
+            self.world_stream = WorldStream(self.protocol, deferred, lambda: self.finish_deferred_chunks(deferred))
+            self.world_stream.start()
+
+    # Everything in the world other than chunks, sent once the chunks around spawn are loaded
+    def send_world_entities(self):
+        self.world_entities_start = self.last_entity_id
         self.spawn_player()
         self.send_maps()
         self.send_status_holograms()
@@ -160,14 +229,15 @@ class Version(object, metaclass=abc.ABCMeta):
             self.send_debug_markers()
 
         # Start/stop rain as necessary
-        self.send_weather(self.current_world.weather == 'rain')
+        rain = self.current_world.weather == 'rain'
+        self.send_cached(('weather', rain), lambda: self.send_weather(rain))
 
-        self.send_time()
+        self.send_cached(('time', self.current_world), self.send_time)
 
         # Credits and entry navigation
         if self.protocol.voting_mode:
             self.send_chat_message(entry_component(
-                worlds[self.chunk_format].index(self.current_world) + 1,
+                self.current_world.index + 1,
                 len(worlds[self.chunk_format])))
 
             self.send_chat_message(self.current_world.credit_component())
@@ -175,6 +245,14 @@ class Version(object, metaclass=abc.ABCMeta):
             if not self.is_bedrock:
                 self.send_chat_message(entry_navigation_component(self.protocol.uuid, self.protocol.voting_secret))
 
+    def finish_deferred_chunks(self, deferred: List[WorldPacket]):
+        self.world_stream = None
+        self.add_sent_chunks(deferred)
+
+    # Remember the chunks the client now has, for in-place world switches
+    def add_sent_chunks(self, packets: List[WorldPacket]):
+        self.sent_chunks.update(packet.chunk for packet in packets if packet.chunk is not None)
+
     def send_maps(self):
         if self.map_format is None:
             return
@@ -224,16 +302,38 @@ class Version(object, metaclass=abc.ABCMeta):
 
             self.status_holograms[hologram.server].append(holograms)
 
-    def send_status_hologram_texts(self):
+    # Send status text for the given servers, or all servers if None
+    def send_status_hologram_texts(self, servers: Optional[Set[str]] = None):
         for server, holograms in self.status_holograms.items():
-            lines = self.protocol.factory.server_statuses.get(server, None)
+            if servers is not None and server not in servers:
+                continue
 
-            if self.protocol.debug_mode is True:
-                lines = chat.Message("Line 1 for " + server + " server status\n\nLine 2 for " + server + " server status")
+            metadata = self.get_status_hologram_text_metadata(server)
 
-            if lines is not None:
+            if metadata is not None:
                 for hologram in holograms:
-                    self.send_entity_metadata(hologram[0], self.get_status_hologram_metadata(lines))
+                    self.send_encoded_entity_metadata(hologram[0], metadata)
+
+    # Encoded hologram metadata for a server's status, shared by all connections using the same protocol version
+    def get_status_hologram_text_metadata(self, server: str) -> Optional[bytes]:
+        if self.protocol.debug_mode is True:
+            lines = chat.Message("Line 1 for " + server + " server status\n\nLine 2 for " + server + " server status")
+            return self.protocol.buff_type.pack_entity_metadata(self.get_status_hologram_metadata(lines))
+
+        lines = self.protocol.factory.server_statuses.get(server, None)
+
+        if lines is None:
+            return None
+
+        # Statuses are replaced rather than modified when they change, so the message identifies the status
+        key = (self.protocol_version, server)
+        cached = Version.status_metadata.get(key)
+
+        if cached is None or cached[0] is not lines:
+            cached = (lines, self.protocol.buff_type.pack_entity_metadata(self.get_status_hologram_metadata(lines)))
+            Version.status_metadata[key] = cached
+
+        return cached[1]
 
     def send_debug_markers(self):
         spawn = self.current_world.spawn
@@ -246,43 +346,153 @@ class Version(object, metaclass=abc.ABCMeta):
                         self.send_debug_marker([x, y, z], 'Portal to {}'.format(portal.destination), 0, 150, 0)
 
     def spawn_player(self, effects=False):
-        self.send_spawn()
+        self.last_block = None
+
+        self.send_cached(('spawn', self.current_world), self.send_spawn)
 
         if effects is True:
-            self.send_spawn_effect()
+            self.send_cached(('spawn_effect', self.current_world), self.send_spawn_effect)
 
     def reset_world(self, effects=False):
-        if self.protocol.debug_mode:
-            self.clear_debug_markers()
+        if self.world_stream is not None:
+            self.world_stream.cancel()
+            self.world_stream = None
 
-        self.status_holograms = dict()
-        self.send_respawn()
+        # The client drops its chunks on respawn, and has nothing until send_world runs
+        self.sent_chunks = set()
+        self.reset_pending = True
+        self.protocol.cork()
+
+        try:
+            if self.protocol.debug_mode:
+                self.clear_debug_markers()
+
+            self.status_holograms = dict()
+            self.send_respawn()
+        finally:
+            self.protocol.uncork()
 
         self.protocol.ticker.add_delay(1, self.send_world)
-        self.protocol.ticker.add_delay(20, self.send_music)
+        self.protocol.ticker.add_delay(20, self.send_cached_music)
 
         if effects is True:
-            self.protocol.ticker.add_delay(2, self.send_reset_sound)
+            self.protocol.ticker.add_delay(2, lambda: self.send_cached(('reset_sound', self.current_world),
+                                                                       self.send_reset_sound))
 
     def next_world(self):
-        if len(worlds[self.chunk_format]) > 1:
-            index = worlds[self.chunk_format].index(self.current_world)
-            next_index = index + 1 if index < len(worlds[self.chunk_format]) - 1 else 0
-            self.current_world = worlds[self.chunk_format][next_index]
-
-        self.reset_world()
+        self.switch_world(1)
 
     def previous_world(self):
-        if len(worlds[self.chunk_format]) > 1:
-            index = worlds[self.chunk_format].index(self.current_world)
-            prev_index = index - 1 if index > 0 else len(worlds[self.chunk_format]) - 1
-            self.current_world = worlds[self.chunk_format][prev_index]
+        self.switch_world(-1)
+
+    def switch_world(self, offset: int):
+        entries = worlds[self.chunk_format]
+
+        if len(entries) > 1:
+            previous = self.current_world
+            self.change_world(entries[(previous.index + offset) % len(entries)])
+
+            # Worlds in the same dimension are switched without a respawn, if the previous world was fully sent
+            if self.current_world.dimension == previous.dimension and self.world_stream is None \
+                    and not self.reset_pending:
+                self.switch_world_in_place(previous)
+                return
 
         self.reset_world()
 
+    # Replace only the chunks which differ from the previous world, and the entities
+    def switch_world_in_place(self, previous: World):
+        forgotten, packets, deferred = self.current_world.get_switch_packets(previous, self.sent_chunks,
+                                                                             self.protocol.view_distance)
+        self.sent_chunks.difference_update(forgotten)
+        self.protocol.cork()
+
+        try:
+            if self.protocol.debug_mode:
+                self.clear_debug_markers()
+
+            self.send_remove_entities(previous.get_entity_ids() +
+                                      list(range(self.world_entities_start, self.last_entity_id)))
+            self.send_forget_chunks(forgotten)
+        finally:
+            self.protocol.uncork()
+
+        self.status_holograms = dict()
+        self.world_stream = WorldStream(self.protocol, packets, lambda: self.finish_world(packets, deferred))
+        self.world_stream.start()
+
+        self.protocol.ticker.add_delay(20, self.send_cached_music)
+
+    # Frame the packets of the entries either side of the current one in the background
+    # Switching to them then only has to write the already framed packets
+    def prefetch_neighbours(self):
+        entries = worlds[self.chunk_format]
+        key = (self.protocol.protocol_version, self.protocol.compression_threshold)
+
+        for offset in (1, -1):
+            world = entries[(self.current_world.index + offset) % len(entries)]
+
+            if world is not self.current_world and key not in world.prefetched:
+                world.prefetched.add(key)
+                cooperate(self.prefetch_world(world, key))
+
+    # Every chunk is framed, as framed packets are shared by connections with any view distance
+    def prefetch_world(self, world: World, key: tuple):
+        packets, deferred = world.get_packets()
+        world.get_chunk_digests()
+        world.get_entity_ids()
+
+        for packet in packets + deferred:
+            yield
+
+            # Stop if the world was unloaded as idle in between, or the connection has closed
+            if not world.loaded or self.protocol.closed:
+                world.prefetched.discard(key)
+                return
+
+            packet.get_framed(self.protocol)
+
+    # Send the packets sent by send, encoding them once and reusing the bytes for every connection with the same key
+    # The key must identify everything the packets depend on, other than the protocol version and compression threshold
+    def send_cached(self, key: tuple, send: Callable[[], None]):
+        if self.protocol.closed:
+            return
+
+        key = (self.protocol.protocol_version, self.protocol.compression_threshold) + key
+        packets = Version.packet_cache.get(key)
+
+        if packets is None:
+            packets = self.protocol.capture_packets(send)
+            Version.packet_cache[key] = packets
+
+        for name, data in packets:
+            self.protocol.send_framed(name, data)
+
+    def send_cached_music(self, stop=False):
+        self.send_cached(('music', self.current_world, stop), lambda: self.send_music(stop))
+
+    # Data pack to apply, built once per protocol version and shared by all connections
     def get_data_pack(self) -> Optional[DataPack]:
+        if self.protocol_version not in Version.data_packs:
+            Version.data_packs[self.protocol_version] = self.build_data_pack()
+
+        return Version.data_packs[self.protocol_version]
+
+    def build_data_pack(self) -> Optional[DataPack]:
         return None
 
+    # Index of a dimension type in the registry sent during configuration
+    def get_dimension_id(self, dimension: NamespacedKey) -> int:
+        key = (self.protocol_version, dimension)
+        id = Version.dimension_ids.get(key)
+
+        if id is None:
+            dimension_registry = self.protocol.data_packs.get_registry(NamespacedKey.minecraft('dimension_type'))
+            id = list(dimension_registry).index(dimension)
+            Version.dimension_ids[key] = id
+
+        return id
+
     @abc.abstractmethod
     def send_join_game(self):
         raise NotImplementedError('send_join_game must be defined to use this base class')
@@ -347,6 +557,18 @@ class Version(object, metaclass=abc.ABCMeta):
     def send_entity_metadata(self, entity_id: int, metadata: Dict[Tuple[int, int], Union[str, int, bool]]):
         raise NotImplementedError('send_entity_metadata must be defined to use this base class')
 
+    @abc.abstractmethod
+    def send_encoded_entity_metadata(self, entity_id: int, metadata: bytes):
+        raise NotImplementedError('send_encoded_entity_metadata must be defined to use this base class')
+
+    @abc.abstractmethod
+    def send_remove_entities(self, entity_ids: List[int]):
+        raise NotImplementedError('send_remove_entities must be defined to use this base class')
+
+    @abc.abstractmethod
+    def send_forget_chunks(self, chunks: List[Tuple[int, int]]):
+        raise NotImplementedError('send_forget_chunks must be defined to use this base class')
+
     @abc.abstractmethod
     def send_map_frame(self, pos: List[float], direction: Direction, map_id: int):
         raise NotImplementedError('send_map_frame must be defined to use this base class')
@@ -355,6 +577,23 @@ class Version(object, metaclass=abc.ABCMeta):
     def send_map_data(self, part: MapPart):
         raise NotImplementedError('send_map_data must be defined to use this base class')
 
+    # Encode the map_item_data packet body for each map in this version's map_format, once per encoder
+    # Called by build_versions() after the config is loaded
+    @classmethod
+    def prepare_maps(cls):
+        if cls.map_format is None:
+            return
+
+        for map in maps.get(cls.map_format, dict()).values():
+            for part in map.maps:
+                if cls.encode_map_data not in part.bodies:
+                    part.bodies[cls.encode_map_data] = cls.encode_map_data(part)
+
+    @staticmethod
+    @abc.abstractmethod
+    def encode_map_data(part: MapPart) -> bytes:
+        raise NotImplementedError('encode_map_data must be defined to use this base class')
+
     @abc.abstractmethod
     def send_status_hologram(self, pos: List[float]):
         raise NotImplementedError('send_status_hologram must be defined to use this base class')
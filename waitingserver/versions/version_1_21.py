@@ -2,6 +2,7 @@ from copy import deepcopy
 from typing import List, Dict, Tuple, Union
 
 from quarry.data.data_packs import vanilla_data_packs, pack_formats
+from quarry.types.buffer import Buffer
 from quarry.types.chat import Message
 from quarry.types.data_pack import DataPack
 from quarry.types.namespaced_key import NamespacedKey
@@ -24,8 +25,6 @@ class Version_1_21(Version):
     map_entity_id = 47  # Glow item frame
     map_item_id = 982  # Filled map
 
-    data_pack: DataPack = None  # Data pack to apply
-
     def __init__(self, protocol: Protocol, bedrock: bool = False):
         super().__init__(protocol, bedrock)
 
@@ -98,10 +97,7 @@ class Version_1_21(Version):
                 "suggestions": None
             }
 
-    def get_data_pack(self):
-        if self.data_pack:
-            return self.data_pack
-
+    def build_data_pack(self):
         vanilla_pack = vanilla_data_packs[self.protocol_version]
 
         # Make void sky and fog black
@@ -123,8 +119,7 @@ class Version_1_21(Version):
             }
         }
 
-        self.data_pack = DataPack(NamespacedKey("rtgame", "waitingserver"), "1.0", pack_formats[self.protocol_version], contents)
-        return self.data_pack
+        return DataPack(NamespacedKey("rtgame", "waitingserver"), "1.0", pack_formats[self.protocol_version], contents)
 
     def get_dimension_settings(self, name: str):
         return {
@@ -148,8 +143,7 @@ class Version_1_21(Version):
         }
 
     def send_join_game(self):
-        dimension_registry = self.protocol.data_packs.get_registry(NamespacedKey.minecraft('dimension_type'))
-        id = list(dimension_registry).index(self.current_world.dimension)
+        id = self.get_dimension_id(self.current_world.dimension)
 
         self.protocol.send_packet("login",
                                   self.protocol.buff_type.pack("i?", 0, False),
@@ -199,8 +193,7 @@ class Version_1_21(Version):
         self.send_global_sound("minecraft:entity.enderman.teleport", 6)
 
     def send_respawn(self):
-        dimension_registry = self.protocol.data_packs.get_registry(NamespacedKey.minecraft('dimension_type'))
-        id = list(dimension_registry).index(self.current_world.dimension)
+        id = self.get_dimension_id(self.current_world.dimension)
 
         self.protocol.send_packet("respawn",
                                   self.protocol.buff_type.pack_varint(id), # Now varint
@@ -287,9 +280,9 @@ class Version_1_21(Version):
                                   self.protocol.buff_type.pack("?", False))  # Not an overlay (action bar) message
 
     def send_tablist(self):
-        self.protocol.send_packet("tab_list",
-                                  self.protocol.buff_type.pack_chat("\n\ue300\n"),
-                                  self.protocol.buff_type.pack_chat(""))
+        self.send_cached(('tab_list',), lambda: self.protocol.send_packet("tab_list",
+                                                                          self.protocol.buff_type.pack_chat("\n\ue300\n"),
+                                                                          self.protocol.buff_type.pack_chat("")))
 
         self.protocol.send_packet("player_info_update",
                                   self.protocol.buff_type.pack('B', 29),
@@ -322,6 +315,16 @@ class Version_1_21(Version):
                                   self.protocol.buff_type.pack(message_format, len(connect), connect, len(server),
                                                                server))
 
+    def send_remove_entities(self, entity_ids: List[int]):
+        self.protocol.send_packet("remove_entities",
+                                  self.protocol.buff_type.pack_varint(len(entity_ids)),
+                                  *[self.protocol.buff_type.pack_varint(entity_id) for entity_id in entity_ids])
+
+    def send_forget_chunks(self, chunks: List[Tuple[int, int]]):
+        for x, z in chunks:
+            # Chunk position as a long, z in the upper half
+            self.protocol.send_packet("forget_level_chunk", self.protocol.buff_type.pack("ii", z, x))
+
     def send_map_frame(self, pos: List[float], direction: Direction, map_id: int):
         self.protocol.send_packet("add_entity",
                                   self.protocol.buff_type.pack_varint(self.last_entity_id),
@@ -343,24 +346,14 @@ class Version_1_21(Version):
         }
 
     def send_map_data(self, part: MapPart):
-        if self.map_packets.get(self.map_format) is None:
-            self.map_packets[self.map_format] = dict()
-
-        if self.map_packets[self.map_format].get(part.map_id) is not None:
-            self.protocol.send_packet("map_item_data", *self.map_packets[self.map_format][part.map_id])
-            return
+        self.protocol.send_framed("map_item_data", part.get_framed(self.protocol, part.bodies[self.encode_map_data]))
 
-        data = [
-            self.protocol.buff_type.pack_varint(part.map_id),
-            self.protocol.buff_type.pack("b??BBBB", 0, True, False, 128, 128, 0, 0),
-            self.protocol.buff_type.pack_varint(len(part.data))
-        ]
-
-        for i in range(0, 16384):
-            data.append(self.protocol.buff_type.pack("B", part.data[i]))
-
-        self.map_packets[self.map_format][part.map_id] = data
-        self.protocol.send_packet("map_item_data", *data)
+    @staticmethod
+    def encode_map_data(part: MapPart) -> bytes:
+        return Buffer.pack_varint(part.map_id) + \
+               Buffer.pack("b??BBBB", 0, True, False, 128, 128, 0, 0) + \
+               Buffer.pack_varint(len(part.colors)) + \
+               part.colors
 
     def send_status_hologram(self, pos: List[float]):
         entity_id = self.last_entity_id
@@ -378,9 +371,12 @@ class Version_1_21(Version):
         return entity_id
 
     def send_entity_metadata(self, entity_id: int, metadata: Dict[Tuple[int, int], Union[str, int, bool]]):
+        self.send_encoded_entity_metadata(entity_id, self.protocol.buff_type.pack_entity_metadata(metadata))
+
+    def send_encoded_entity_metadata(self, entity_id: int, metadata: bytes):
         self.protocol.send_packet("set_entity_data",
                                   self.protocol.buff_type.pack_varint(entity_id),
-                                  self.protocol.buff_type.pack_entity_metadata(metadata))
+                                  metadata)
 
     @staticmethod
     def get_status_hologram_metadata(text: Message = "") -> Dict[Tuple[int, int], Union[str, int, bool]]:
@@ -21,10 +21,7 @@ class Version_1_21_11(Version_1_21_9):
     def __init__(self, protocol: Protocol, bedrock: bool = False):
         super().__init__(protocol, bedrock)
 
-    def get_data_pack(self):
-        if self.data_pack:
-            return self.data_pack
-
+    def build_data_pack(self):
         vanilla_pack = vanilla_data_packs[self.protocol_version]
 
         # Remove void overrides
@@ -48,8 +45,7 @@ class Version_1_21_11(Version_1_21_9):
             }
         }
 
-        self.data_pack = DataPack(NamespacedKey("rtgame", "waitingserver"), "1.0", pack_formats[self.protocol_version], contents)
-        return self.data_pack
+        return DataPack(NamespacedKey("rtgame", "waitingserver"), "1.0", pack_formats[self.protocol_version], contents)
 
     def get_dimension_settings(self, name: str):
         vanilla_pack = vanilla_data_packs[self.protocol_version]
@@ -1,5 +1,3 @@
-from quarry.types.namespaced_key import NamespacedKey
-
 from waitingserver.protocol import Protocol
 from waitingserver.versions import Version_1_21
 
@@ -16,8 +14,7 @@ class Version_1_21_2(Version_1_21):
         super().__init__(protocol, bedrock)
 
     def send_join_game(self):
-        dimension_registry = self.protocol.data_packs.get_registry(NamespacedKey.minecraft('dimension_type'))
-        id = list(dimension_registry).index(self.current_world.dimension)
+        id = self.get_dimension_id(self.current_world.dimension)
 
         self.protocol.send_packet("login",
                                   self.protocol.buff_type.pack("i?", 0, False),
@@ -63,8 +60,7 @@ class Version_1_21_2(Version_1_21):
                                                                self.current_world.cycle)) # Boolean for fixed time instead of negative time value
 
     def send_respawn(self):
-        dimension_registry = self.protocol.data_packs.get_registry(NamespacedKey.minecraft('dimension_type'))
-        id = list(dimension_registry).index(self.current_world.dimension)
+        id = self.get_dimension_id(self.current_world.dimension)
 
         self.protocol.send_packet("respawn",
                                   self.protocol.buff_type.pack_varint(id),
@@ -1,5 +1,3 @@
-from quarry.types.namespaced_key import NamespacedKey
-
 from waitingserver.protocol import Protocol
 from waitingserver.versions import Version_26_1
 
@@ -15,8 +13,7 @@ class Version_26_2(Version_26_1):
         super().__init__(protocol, bedrock)
 
     def send_join_game(self):
-        dimension_registry = self.protocol.data_packs.get_registry(NamespacedKey.minecraft('dimension_type'))
-        id = list(dimension_registry).index(self.current_world.dimension)
+        id = self.get_dimension_id(self.current_world.dimension)
 
         self.protocol.send_packet("login",
                                   self.protocol.buff_type.pack("i?", 830, False),
@@ -0,0 +1,210 @@
+import mmap
+import os
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+from typing import Dict, List, Optional
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.protocol import ProcessProtocol
+
+from waitingserver.log import logger
+
+# Multi-process worker mode
+# A supervisor process spawns a worker per core. Each worker loads the config and listens on the same port with
+# SO_REUSEPORT, leaving the kernel to balance connections between them. Packed world archives are mmapped, so their
+# pages are shared between workers through the page cache.
+# Worker player counts are kept in a small shared file, so the max player limit applies to the total across workers.
+# Pushed status updates are received by the supervisor and relayed to each worker over its stdin.
+# Workers which exit are restarted, with a delay which doubles for each exit shortly after starting.
+
+RESTART_DELAY = 1.0  # Seconds before restarting a worker which has exited
+MAX_RESTART_DELAY = 60.0
+STABLE_TIME = 30.0  # Seconds a worker must run for before its restart delay is reset
+STOP_TIMEOUT = 10.0  # Seconds to wait for workers to exit on shutdown before killing them
+
+worker_index: Optional[int] = None
+worker_count = 1
+player_counts: Optional[mmap.mmap] = None
+
+count_struct = struct.Struct('<i')
+length_struct = struct.Struct('!I')  # Matches twisted's Int32StringReceiver
+
+
+def is_worker() -> bool:
+    return worker_index is not None
+
+
+# Map the shared player count file created by the supervisor
+def attach_player_counts(path: str, index: int, count: int):
+    global worker_index
+    global worker_count
+    global player_counts
+
+    worker_index = index
+    worker_count = count
+
+    with open(path, 'r+b') as file:
+        player_counts = mmap.mmap(file.fileno(), count_struct.size * count)
+
+
+def set_player_count(count: int):
+    if player_counts is not None:
+        count_struct.pack_into(player_counts, count_struct.size * worker_index, count)
+
+
+# Total player count across all workers, or None if not running as a worker
+def get_total_players() -> Optional[int]:
+    if player_counts is None:
+        return None
+
+    return sum(count_struct.unpack_from(player_counts, count_struct.size * i)[0] for i in range(0, worker_count))
+
+
+# Listen on a socket shared with the other workers
+def listen_reuseport(factory, host: str, port: int):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+
+    port = reactor.adoptStreamPort(sock.fileno(), family, factory)
+    sock.close()  # adoptStreamPort duplicates the socket
+
+    return port
+
+
+class WorkerProcess(ProcessProtocol):
+
+    def __init__(self, supervisor: 'Supervisor', index: int):
+        self.supervisor = supervisor
+        self.index = index
+        self.pid = None
+        self.started = reactor.seconds()
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+
+class Supervisor:
+
+    def __init__(self, count: int, argv: List[str]):
+        self.count = count
+        self.argv = argv
+        self.workers: List[WorkerProcess] = []
+        self.stopping = False
+        self.args: List[str] = []
+        self.env: Dict[str, str] = dict()
+        self.restart_delays: Dict[int, float] = dict()  # Worker index -> delay before its next restart
+        self.restarts = dict()  # Worker index -> pending restart call
+        self.stopped: Optional[Deferred] = None  # Fired once every worker has exited after stop()
+        self.kill_call = None
+
+        self.metrics_dir = tempfile.mkdtemp(prefix='waitingserver-metrics-')
+        fd, self.player_counts_path = tempfile.mkstemp(prefix='waitingserver-players-')
+        os.write(fd, bytes(count_struct.size * count))
+        self.player_counts = mmap.mmap(fd, count_struct.size * count)
+        os.close(fd)
+
+    def start(self):
+        if getattr(sys, 'frozen', False):
+            self.args = [sys.executable] + self.argv
+        else:
+            self.args = [sys.executable, '-m', 'waitingserver'] + self.argv
+
+        self.env = dict(os.environ)
+        self.env['PROMETHEUS_MULTIPROC_DIR'] = self.metrics_dir
+
+        for i in range(0, self.count):
+            self.spawn_worker(i)
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        logger.info('Started {} workers'.format(self.count))
+
+    def spawn_worker(self, index: int):
+        self.restarts.pop(index, None)
+
+        worker = WorkerProcess(self, index)
+        worker_args = self.args + ['--worker', str(index), '--player-counts', self.player_counts_path]
+
+        process = reactor.spawnProcess(worker, self.args[0], worker_args, env=self.env, path=os.getcwd(),
+                                       childFDs={0: 'w', 1: 1, 2: 2})
+        worker.pid = process.pid
+        self.workers.append(worker)
+
+    # Relay a status update to every worker over its stdin, as a length prefixed message
+    def send_status(self, data: bytes):
+        message = length_struct.pack(len(data)) + data
+
+        for worker in self.workers:
+            worker.transport.write(message)
+
+    # Signal every worker to exit, returning a Deferred which fires once they all have and files are cleaned up
+    def stop(self) -> Deferred:
+        self.stopping = True
+
+        for call in self.restarts.values():
+            call.cancel()
+
+        self.restarts.clear()
+
+        if len(self.workers) == 0:
+            self.cleanup()
+            return succeed(None)
+
+        self.stopped = Deferred()
+        self.stopped.addCallback(lambda _: self.cleanup())
+        self.kill_call = reactor.callLater(STOP_TIMEOUT, self.kill)
+
+        for worker in self.workers:
+            worker.transport.signalProcess(signal.SIGTERM)
+
+        return self.stopped
+
+    # Kill workers which haven't exited after being signalled
+    def kill(self):
+        for worker in self.workers:
+            logger.warning('Worker {} did not exit, killing'.format(worker.index))
+            worker.transport.signalProcess(signal.SIGKILL)
+
+    def worker_ended(self, worker: WorkerProcess, reason):
+        from prometheus_client import multiprocess
+
+        logger.warning('Worker {} exited: {}'.format(worker.index, reason.getErrorMessage()))
+
+        # Don't count the players of a worker that has gone away
+        count_struct.pack_into(self.player_counts, count_struct.size * worker.index, 0)
+        multiprocess.mark_process_dead(worker.pid, self.metrics_dir)
+        self.workers.remove(worker)
+
+        if self.stopping:
+            if len(self.workers) == 0 and self.stopped is not None:
+                if self.kill_call.active():
+                    self.kill_call.cancel()
+
+                self.stopped.callback(None)
+
+            return
+
+        # Back off restarts of workers which keep exiting soon after starting
+        if reactor.seconds() - worker.started >= STABLE_TIME:
+            delay = RESTART_DELAY
+        else:
+            delay = min(MAX_RESTART_DELAY, self.restart_delays.get(worker.index, RESTART_DELAY / 2) * 2)
+
+        self.restart_delays[worker.index] = delay
+        self.restarts[worker.index] = reactor.callLater(delay, self.spawn_worker, worker.index)
+        logger.info('Restarting worker {} in {:.1f}s'.format(worker.index, delay))
+
+    def cleanup(self):
+        shutil.rmtree(self.metrics_dir, ignore_errors=True)
+
+        if os.path.exists(self.player_counts_path):
+            os.remove(self.player_counts_path)
@@ -1,21 +1,30 @@
 import glob
+import hashlib
 import os
-import re
 import math
+import time
 
 from quarry.types.buffer import Buffer
-from typing import List
+from typing import List, Optional, Tuple, Dict, Set
+from weakref import WeakValueDictionary
 
 from quarry.types.chat import Message
 from quarry.types.namespaced_key import NamespacedKey
 
+from waitingserver.archive import WorldArchive, ArchiveEntry, ARCHIVE_EXTENSION, parse_packet_filename, \
+	read_archive_index
+from waitingserver.cache import asset_cache, file_key, folder_key
 from waitingserver.direction import Direction
 
+PORTAL_CELL_SIZE = 16  # Size of the grid cells portals are indexed by
+
 
 class World:
 
-	def __init__(self, name: str, folder: str, version: str, config: dict):
+	def __init__(self, name: str, folder: str, version: str, config: dict, lazy: bool = False):
 		self.name = name
+		self.folder = folder
+		self.version = version
 
 		environment = config.get('environment', dict())
 
@@ -30,17 +39,44 @@ class World:
 		self.portals: List[WorldPortal] = []
 		self.maps: List[WorldMap] = []
 		self.holograms: List[WorldStatusHologram] = []
-		self.bounds = None
+		self.portal_cells: Dict[Tuple[int, int], Tuple[WorldPortal, ...]] = dict()
+		self.bounds: Optional[Tuple[int, int, int, int, int, int]] = None
 		self.spawn = {"x": 0, "y": 0, "z": 0, "yaw": 0, "yaw_256": 0, "pitch": 0}
 
-		path = os.path.join(os.getcwd(), './packets', folder, version, '*.bin')
+		self.loaded = False
+		self.last_used = 0
+		self.ordered_packets: Dict[Optional[int], Tuple[List[WorldPacket], List[WorldPacket]]] = dict()
+
+		self.archive = None
+
+		self.index = 0  # Position in the list of worlds for this version
+		self.chunk_digests: Optional[Dict[Tuple[int, int], bytes]] = None  # Digest of each chunk's packets
+		self.entity_ids: Optional[List[int]] = None  # Ids of the entities added by this world's packets
+		self.prefetched = set()  # (protocol version, compression threshold) already framed
+
+		path = os.path.join(os.getcwd(), './packets', folder, version)
 
-		for filename in sorted(glob.glob(path)):
-			file = open(filename, 'rb')
-			packet_type = re.match(r'(\d+)(?:_dn)?_([a-z_]+)(_[\w-]*)?.bin', os.path.basename(filename))
+		# Index packets from the packed archive if one exists, otherwise from individual files
+		# Indexes are kept in the asset cache, data is read by load()
+		if os.path.exists(path + ARCHIVE_EXTENSION):
+			archive_path = path + ARCHIVE_EXTENSION
+			entries = asset_cache.get('archive', archive_path, file_key(archive_path),
+									  lambda: read_archive_index(archive_path))
+			self.archive = WorldArchive(archive_path, entries)
 
-			self.packets.append(WorldPacket(packet_type.group(1), packet_type.group(2), Buffer(file.read()).read()))
-			file.close()
+			for entry in self.archive.entries:
+				self.packets.append(WorldPacket(entry.id, entry.type, None, entry.chunk, archive=self.archive,
+												entry=entry))
+		else:
+			index = asset_cache.get('packets', path, folder_key(path), lambda: [
+				(filename,) + parse_packet_filename(filename) for filename in sorted(glob.glob(os.path.join(path, '*.bin')))
+			])
+
+			for filename, id, packet_type, dn, chunk in index:
+				self.packets.append(WorldPacket(id, packet_type, None, chunk, filename=filename))
+
+		if lazy is False:
+			self.load()
 
 		parts = [0, 0, 0, 0, 0]
 
@@ -68,6 +104,16 @@ class World:
 
 			self.portals.append(WorldPortal(pos1, pos2, portal.get('server', None)))
 
+		# Index portals by the grid cells they overlap, so lookups only check portals near the player
+		portal_cells = dict()
+
+		for portal in self.portals:
+			for x in range(portal.aabb[0] // PORTAL_CELL_SIZE, (portal.aabb[3] - 1) // PORTAL_CELL_SIZE + 1):
+				for z in range(portal.aabb[2] // PORTAL_CELL_SIZE, (portal.aabb[5] - 1) // PORTAL_CELL_SIZE + 1):
+					portal_cells.setdefault((x, z), []).append(portal)
+
+		self.portal_cells = {cell: tuple(portals) for cell, portals in portal_cells.items()}
+
 		for map in config.get('maps', list()):
 			pos = [0, 0, 0]
 
@@ -84,6 +130,8 @@ class World:
 
 			self.holograms.append(WorldStatusHologram(hologram.get('server'), pos))
 
+		self.hologram_servers = frozenset(hologram.server for hologram in self.holograms)
+
 		if 'bounds' in config:
 			bounds = config.get('bounds')
 			pos1 = [0, 0, 0]
@@ -95,47 +143,131 @@ class World:
 			for i, part in enumerate(bounds.get('pos2', '').split(',')):
 				pos2[i] = math.floor(float(part))
 
-			self.bounds = {
-				"pos1": pos1,
-				"pos2": pos2,
-			}
+			self.bounds = get_aabb(pos1, pos2)
+
+		# Lists are only appended to while loading, keep them as tuples for the lifetime of the server
+		self.packets = tuple(self.packets)
+		self.portals = tuple(self.portals)
+		self.maps = tuple(self.maps)
+		self.holograms = tuple(self.holograms)
+
+	# Read packet data for this world, if not already loaded
+	def load(self):
+		if self.loaded:
+			return
+
+		for packet in self.packets:
+			packet.load()
+
+		self.loaded = True
+
+	# Drop packet data and framed packet caches, leaving only the index
+	def unload(self):
+		for packet in self.packets:
+			packet.unload()
+
+		self.prefetched.clear()
+		self.loaded = False
+
+	# Packets to send for this world, loading them first if required
+	# Chunk and light packets are sent first, nearest to spawn first. Other packets keep their original order.
+	# Chunks outside the given view distance of spawn are returned separately, to be sent after everything else.
+	def get_packets(self, view_distance: Optional[int] = None) -> Tuple[List['WorldPacket'], List['WorldPacket']]:
+		self.last_used = time.time()
+		self.load()
+
+		packets = self.ordered_packets.get(view_distance)
+
+		if packets is None:
+			spawn_x = math.floor(self.spawn.get('x')) >> 4
+			spawn_z = math.floor(self.spawn.get('z')) >> 4
+
+			def distance(packet: WorldPacket):
+				return (packet.chunk[0] - spawn_x) ** 2 + (packet.chunk[1] - spawn_z) ** 2
+
+			chunks = sorted((packet for packet in self.packets if packet.chunk is not None), key=distance)
+			others = [packet for packet in self.packets if packet.chunk is None]
+
+			if view_distance is None:
+				packets = (chunks + others, [])
+			else:
+				limit = (view_distance + 1) ** 2
+
+				packets = ([packet for packet in chunks if distance(packet) <= limit] + others,
+						   [packet for packet in chunks if distance(packet) > limit])
+
+			self.ordered_packets[view_distance] = packets
+
+		return packets
+
+	# Digest of the packets for each chunk, used to find the chunks which differ between worlds
+	# Kept when the world is unloaded, as the packets are unchanged when loaded again
+	def get_chunk_digests(self) -> Dict[Tuple[int, int], bytes]:
+		if self.chunk_digests is None:
+			self.load()
+			digests = dict()
+
+			for packet in self.packets:
+				if packet.chunk is not None:
+					digest = digests.setdefault(packet.chunk, hashlib.blake2b(digest_size=16))
+					digest.update(packet.type.encode('utf-8'))
+					digest.update(len(packet.data).to_bytes(4, 'big'))
+					digest.update(packet.data)
 
+			self.chunk_digests = {chunk: digest.digest() for chunk, digest in digests.items()}
+
+		return self.chunk_digests
+
+	def get_entity_ids(self) -> List[int]:
+		if self.entity_ids is None:
+			self.load()
+			self.entity_ids = [Buffer(bytes(packet.data[:5])).unpack_varint()
+							   for packet in self.packets if packet.type == 'add_entity']
+
+		return self.entity_ids
+
+	# Packets to switch a client from the previous world to this one, without a respawn
+	# sent_chunks are the chunks of the previous world the client has been sent
+	# Returns the chunks to forget, then the packets and deferred packets as get_packets() does, without the
+	# chunks the client already has which are identical in both worlds
+	def get_switch_packets(self, previous: 'World', sent_chunks: Set[Tuple[int, int]],
+						   view_distance: Optional[int] = None) \
+			-> Tuple[List[Tuple[int, int]], List['WorldPacket'], List['WorldPacket']]:
+		previous_digests = previous.get_chunk_digests()
+		digests = self.get_chunk_digests()
+		packets, deferred = self.get_packets(view_distance)
+
+		def changed(packet: WorldPacket):
+			return packet.chunk is None or packet.chunk not in sent_chunks \
+				or previous_digests.get(packet.chunk) != digests[packet.chunk]
+
+		return ([chunk for chunk in sent_chunks if chunk not in digests],
+				[packet for packet in packets if changed(packet)],
+				[packet for packet in deferred if changed(packet)])
+
+	# Coordinates are compared against the exclusive upper bounds of each box, so no flooring is needed
+	# Cell keys are left as floats (which hash equally to ints), as int() would raise for nan/inf
 	def get_portal_at(self, x, y, z):
-		x = math.floor(x)
-		y = math.floor(y)
-		z = math.floor(z)
+		portals = self.portal_cells.get((x // PORTAL_CELL_SIZE, z // PORTAL_CELL_SIZE))
 
-		for portal in self.portals:
-			pos1x = min(portal.pos1[0], portal.pos2[0])
-			pos1y = min(portal.pos1[1], portal.pos2[1])
-			pos1z = min(portal.pos1[2], portal.pos2[2])
+		if portals is None:
+			return None
 
-			pos2x = max(portal.pos1[0], portal.pos2[0])
-			pos2y = max(portal.pos1[1], portal.pos2[1])
-			pos2z = max(portal.pos1[2], portal.pos2[2])
+		for portal in portals:
+			x1, y1, z1, x2, y2, z2 = portal.aabb
 
-			if pos1x <= x <= pos2x and pos1y <= y <= pos2y and pos1z <= z <= pos2z:
+			if x1 <= x < x2 and y1 <= y < y2 and z1 <= z < z2:
 				return portal.destination
 
 		return None
 
 	def is_within_bounds(self, x, y, z):
-		x = math.floor(x)
-		y = math.floor(y)
-		z = math.floor(z)
-
 		if self.bounds is None:
 			return True
 
-		pos1x = min(self.bounds['pos1'][0], self.bounds['pos2'][0])
-		pos1y = min(self.bounds['pos1'][1], self.bounds['pos2'][1])
-		pos1z = min(self.bounds['pos1'][2], self.bounds['pos2'][2])
-
-		pos2x = max(self.bounds['pos1'][0], self.bounds['pos2'][0])
-		pos2y = max(self.bounds['pos1'][1], self.bounds['pos2'][1])
-		pos2z = max(self.bounds['pos1'][2], self.bounds['pos2'][2])
+		x1, y1, z1, x2, y2, z2 = self.bounds
 
-		return pos1x <= x <= pos2x and pos1y <= y <= pos2y and pos1z <= z <= pos2z
+		return x1 <= x < x2 and y1 <= y < y2 and z1 <= z < z2
 
 	def credit_component(self):
 		if len(self.contributors) > 0:
@@ -169,6 +301,7 @@ class World:
 
 
 class WorldMap:
+	__slots__ = ('map_name', 'pos', 'direction')
 
 	def __init__(self, map_name: str, pos: List[float], direction: Direction):
 		self.map_name = map_name
@@ -177,23 +310,95 @@ class WorldMap:
 
 
 class WorldPortal:
+	__slots__ = ('pos1', 'pos2', 'aabb', 'destination')
 
 	def __init__(self, pos1: List[int], pos2: List[int], destination: str):
 		self.pos1 = pos1
 		self.pos2 = pos2
+		self.aabb = get_aabb(pos1, pos2)
 		self.destination = destination
 
 
+# Normalise two corner blocks into a (min x, min y, min z, max x, max y, max z) box
+# The max values are exclusive, covering the whole of the furthest block
+def get_aabb(pos1: List[int], pos2: List[int]) -> Tuple[int, int, int, int, int, int]:
+	return (min(pos1[0], pos2[0]), min(pos1[1], pos2[1]), min(pos1[2], pos2[2]),
+			max(pos1[0], pos2[0]) + 1, max(pos1[1], pos2[1]) + 1, max(pos1[2], pos2[2]) + 1)
+
+
 class WorldStatusHologram:
+	__slots__ = ('server', 'pos')
 
 	def __init__(self, server: str, pos: List[float]):
 		self.server = server
 		self.pos = pos
 
 
+# Packet data shared by every world packet with the same type and content, along with its framed packets
+# Worlds are often identical across versions, or contain repeated chunks, so this keeps one copy of each
+class PacketPayload:
+	__slots__ = ('data', 'framed', '__weakref__')
+
+	def __init__(self, data: bytes):
+		self.data = data
+		self.framed = dict()  # (protocol version, compression threshold) -> framed packet
+
+
+# Payloads are dropped once no loaded packet uses them
+payloads: 'WeakValueDictionary[Tuple[str, bytes], PacketPayload]' = WeakValueDictionary()
+
+
+def intern_payload(type: str, data: bytes) -> PacketPayload:
+	key = (type, hashlib.blake2b(data, digest_size=16).digest())
+	payload = payloads.get(key)
+
+	if payload is None:
+		payload = PacketPayload(data)
+		payloads[key] = payload
+
+	return payload
+
+
 class WorldPacket:
+	__slots__ = ('id', 'type', 'chunk', 'filename', 'archive', 'entry', 'payload', 'data')
 
-	def __init__(self, id: int, type: str, data: Buffer):
+	def __init__(self, id: int, type: str, data: Optional[bytes], chunk: Optional[Tuple[int, int]] = None,
+				 filename: Optional[str] = None, archive: Optional[WorldArchive] = None,
+				 entry: Optional[ArchiveEntry] = None):
 		self.id = id
 		self.type = type
-		self.data = data
+		self.chunk = chunk  # Chunk coordinates for chunk and light packets
+		self.filename = filename
+		self.archive = archive
+		self.entry = entry
+		self.payload = intern_payload(type, data) if data is not None else None
+		self.data = self.payload.data if self.payload is not None else None
+
+	def load(self):
+		if self.data is not None:
+			return
+
+		if self.archive is not None:
+			data = self.archive.read(self.entry)
+		else:
+			with open(self.filename, 'rb') as file:
+				data = Buffer(file.read()).read()
+
+		self.payload = intern_payload(self.type, data)
+		self.data = self.payload.data
+
+	def unload(self):
+		if self.filename is not None or self.archive is not None:
+			self.data = None
+			self.payload = None
+
+	# Framed and compressed packet, built on first use and shared by every connection using the same key
+	def get_framed(self, protocol) -> bytes:
+		key = (protocol.protocol_version, protocol.compression_threshold)
+		framed = self.payload.framed.get(key)
+
+		if framed is None:
+			framed = protocol.frame_packet(self.type, self.data)
+			self.payload.framed[key] = framed
+
+		return framed